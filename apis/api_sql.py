@@ -1,15 +1,40 @@
 import aiohttp
 import asyncio
+import itertools
 import logging
+import time
 
-from config import CHAINBASE_API_URL, CHAINBASE_API_KEY, API_TIME_LIMIT, API_TIMEOUT
+import ijson
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from config import (CHAINBASE_API_URL, CHAINBASE_API_KEY, API_TIMEOUT,
+                    SQL_CACHE_TTL, SQL_CACHE_MAX_BYTES, SQL_CACHE_DB,
+                    SQL_EXPORT_MAX_BYTES, SQL_EXPORT_CHUNK_SIZE, EXECUTION_REUSE_TTL,
+                    EXECUTION_REGISTRY_MAX_BYTES, MAX_COLUMN_SHOW, MAX_ROW_SHOW, SCAN_COUNT_CAP)
+from apis.cache import TTLCache, SQLiteStore, normalize_sql
+from apis.rate_limit import limited_request, RateLimitedError, PRIORITY_NORMAL
+from apis.poller import BackoffPoller
+from apis.singleflight import single_flight
+from preflight import preview_query, count_query
+from logs import Truncated, SAMPLED
+from metrics import phase_seconds
+from tracing import span
+
+logger = logging.getLogger(__name__)
 
 # Timeout for API requests
 TIMEOUT = aiohttp.ClientTimeout(total=API_TIMEOUT)
 
+# Cache of successful query results, keyed on the normalized SQL
+sql_result_cache = TTLCache("sql_results", SQL_CACHE_MAX_BYTES, default_ttl=SQL_CACHE_TTL,
+                            store=SQLiteStore(SQL_CACHE_DB, "sql_results") if SQL_CACHE_DB else None)
+
+# Live and recent executions: normalized SQL -> execution id, so identical
+# queries re-attach to an execution instead of submitting a new one
+execution_registry = TTLCache("executions", EXECUTION_REGISTRY_MAX_BYTES, default_ttl=EXECUTION_REUSE_TTL)
+# Final status (FINISHED or FAILED) of recent executions and when it was seen, as [status, time];
+# the status never changes once reached
+execution_status = TTLCache("execution_status", EXECUTION_REGISTRY_MAX_BYTES, default_ttl=EXECUTION_REUSE_TTL)
+
 
 # Function to execute the query
 async def execute_query(sql_query):
@@ -19,98 +44,353 @@ async def execute_query(sql_query):
     }
     data = {"sql": sql_query}
 
-    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-        try:
-            async with session.post(f"{CHAINBASE_API_URL}/query/execute", json=data, headers=headers) as response:
+    try:
+        with span("chainbase.execute_query"):
+            async with limited_request('sql_execute', 'POST', f"{CHAINBASE_API_URL}/query/execute",
+                                       json=data, headers=headers, timeout=TIMEOUT) as response:
                 res = await response.json()
-                print(res)
-                print(response)
+                logger.debug("Execute response: %s", Truncated(res), extra={'status': response.status})
                 return res
-        except Exception as e:
-            print(f"Failed to execute query: {e}")
-            return {}
+    except RateLimitedError as e:
+        logger.error("Failed to execute query: %s", e)
+        return {'Error': str(e)}
+    except Exception as e:
+        logger.error("Failed to execute query: %s", e)
+        return {}
 
 
 # Function to check the status of the query execution
-async def check_status(execution_id):
+@single_flight(key=lambda execution_id, *args, **kwargs: execution_id)
+async def check_status(execution_id, priority=PRIORITY_NORMAL):
     headers = {
         "X-API-KEY": CHAINBASE_API_KEY,
         "Content-Type": "application/json"
     }
 
-    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-        try:
-            async with session.get(f"{CHAINBASE_API_URL}/execution/{execution_id}/status", headers=headers) as response:
-                return await response.json()
-        except Exception as e:
-            print(f"Failed to check status: {e}")
-            return {}
+    try:
+        async with limited_request('sql_status', 'GET', f"{CHAINBASE_API_URL}/execution/{execution_id}/status",
+                                   priority=priority, headers=headers, timeout=TIMEOUT) as response:
+            return await response.json()
+    except RateLimitedError as e:
+        logger.error("Failed to check status: %s", e)
+        return {'Error': str(e)}
+    except Exception as e:
+        logger.error("Failed to check status: %s", e)
+        return {}
 
 
 # Function to get the results of the query execution
+@single_flight
 async def get_results(execution_id):
     headers = {
         "X-API-KEY": CHAINBASE_API_KEY,
         "Content-Type": "application/json"
     }
 
-    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-        try:
-            async with session.get(f"{CHAINBASE_API_URL}/execution/{execution_id}/results", headers=headers) as response:
-                return await response.json()
-        except Exception as e:
-            print(f"Failed to get results: {e}")
-            return {}
+    try:
+        async with limited_request('sql_results', 'GET', f"{CHAINBASE_API_URL}/execution/{execution_id}/results",
+                                   headers=headers, timeout=TIMEOUT) as response:
+            return await response.json()
+    except RateLimitedError as e:
+        logger.error("Failed to get results: %s", e)
+        return {'Error': str(e)}
+    except Exception as e:
+        logger.error("Failed to get results: %s", e)
+        return {}
 
 
-async def execute_query_and_fetch_results(query):
-    try:
-        sql_query = query
-        response = await execute_query(sql_query)
+# Function to submit a query and return its execution id
+@single_flight(key=lambda sql_query: normalize_sql(sql_query))
+async def start_execution(sql_query):
+    """
+    Submit a query, or re-attach to a running or recent execution of the same
+    (normalized) query from `execution_registry` instead of paying for a new one.
+
+    Finished executions are only reused for SQL_CACHE_TTL seconds, so their results
+    are never staler than a cached result, and failed ones are never reused.
+
+    Returns:
+    - (execution_id, None), or (None, error message).
+    """
+    registry_key = normalize_sql(sql_query)
+    # The execution id is recorded on this span, as a trace may start several executions (preview and count)
+    with span("chainbase.start_execution") as started:
+        execution_id = await execution_registry.get(registry_key)
+        final = await execution_status.get(execution_id) if execution_id is not None else None
+        if execution_id is not None and (final is None or (final[0] == "FINISHED"
+                                                           and time.time() - final[1] < SQL_CACHE_TTL)):
+            logger.info("Re-attached to execution", extra={'execution_id': execution_id})
+            if started is not None:
+                started.set(execution_id=execution_id, reattached=True)
+            return execution_id, None
 
+        with phase_seconds.time(phase="execute"):
+            response = await execute_query(sql_query)
+
+        if 'Error' in response:
+            return None, response['Error']
         if 'data' in response and response['data']:
             execution_id = response['data'][0].get('executionId')
-            logging.info(f"Execution ID: {execution_id}")
-
-            status = "RUNNING"
-            max_try = 0
-            while status not in ["FINISHED", "FAILED"]:
-                status_response = await check_status(execution_id)
-                max_try += 1
-                if 'data' in status_response and status_response['data']:
-                    status = status_response.get('data', [{}])[0].get('status', 'No status')
-                    logging.info(f"Status: {status}")
-                    if status not in ["FINISHED", "FAILED"]:
-                        await asyncio.sleep(1)
-
-                    if max_try >= API_TIME_LIMIT:
-                        break
-                else:
-                    logging.info("No data found in response of status")
-                    break
-
-            if status in ["FINISHED", "FAILED"]:
-                results = await get_results(execution_id)
-                data = results['data']
-                if 'data' in data:
-                    if data['data']:
-                        columns = data['columns']
-                        internal_data = data['data']
-                        logging.info(f"Columns: {columns}")
-                        logging.info(f"Data: {internal_data}")
-                        return {'Columns': columns, 'Data': internal_data}
-
-                    else:
-                        message = data['message']
-                        logging.info(f"Results: {message}")
-                        return {'Error': message}
-            else:
-                logging.info("Query execution failed")
-                return {'Error': "Query execution failed"}
+            logger.info("Execution started", extra={'execution_id': execution_id})
+            if started is not None:
+                started.set(execution_id=execution_id)
+            await execution_registry.set(registry_key, execution_id)
+            return execution_id, None
         else:
-            logging.info("No data found in response")
-            return {'Error': "No data found in response"}
+            logger.info("No data found in response")
+            return None, "No data found in response"
+
+
+# Function to poll an execution until it has finished
+async def wait_for_execution(execution_id, poller=None, on_progress=None, priority=PRIORITY_NORMAL):
+    """
+    Poll the status of an execution until it is FINISHED or FAILED.
+
+    Parameters:
+    - execution_id: Chainbase execution id.
+    - poller: Polling strategy, defaults to a fresh `BackoffPoller`.
+    - on_progress: Optional coroutine `on_progress(status, elapsed)` called after every status check.
+    - priority: Priority of the status checks in the `sql_status` budget.
+
+    Returns:
+    - None once the execution is done, or an error message.
+    """
+    if poller is None:
+        poller = BackoffPoller()
+
+    # Skip polling executions that are already known to be done
+    final = await execution_status.get(execution_id)
+    status = final[0] if final else "RUNNING"
+    with phase_seconds.time(phase="poll"):
+        while status not in ["FINISHED", "FAILED"] and await poller.wait():
+            with span("chainbase.check_status", execution_id=execution_id) as poll:
+                status_response = await check_status(execution_id, priority)
+                if poll is not None:
+                    poll.set(status=(status_response.get('data') or [{}])[0].get('status'))
+            if 'Error' in status_response:
+                return status_response['Error']
+            if 'data' in status_response and status_response['data']:
+                status = status_response.get('data', [{}])[0].get('status', 'No status')
+                logger.info("Status: %s", status, extra={'execution_id': execution_id, **SAMPLED})
+                if on_progress is not None:
+                    await on_progress(status, poller.elapsed)
+            else:
+                logger.info("No data found in response of status")
+                break
+
+    if status in ["FINISHED", "FAILED"]:
+        if not final:
+            await execution_status.set(execution_id, [status, time.time()])
+        return None
+    if poller.expired:
+        logger.info("Query timed out after %.0fs", poller.elapsed, extra={'execution_id': execution_id})
+        return f"Query timed out after {poller.elapsed:.0f}s (last status: {status})"
+    logger.info("Query execution failed", extra={'execution_id': execution_id})
+    return "Query execution failed"
+
+
+# Function to submit a query and wait until it has finished
+async def submit_and_wait(sql_query, poller=None, on_progress=None):
+    """
+    Execute a query and poll its status until it is FINISHED or FAILED.
+
+    Returns:
+    - (execution_id, None) once the execution is done, or (None, error message).
+    """
+    execution_id, error = await start_execution(sql_query)
+    if error:
+        return None, error
+
+    error = await wait_for_execution(execution_id, poller, on_progress)
+    if error:
+        return None, error
+    return execution_id, None
+
+
+# Concurrent identical queries share one execute/poll/fetch run
+@single_flight(key=lambda query, *args, **kwargs: normalize_sql(query))
+async def execute_query_and_fetch_results(query, poller=None, on_progress=None, use_cache=True):
+    """
+    Execute a query, poll its status and fetch the results.
+
+    Parameters:
+    - query: SQL query string.
+    - poller: Polling strategy, defaults to a fresh `BackoffPoller`.
+    - on_progress: Optional coroutine `on_progress(status, elapsed)` called after every status check.
+    - use_cache: Serve and store successful results in `sql_result_cache`.
+    """
+    try:
+        sql_query = query
+        cache_key = normalize_sql(sql_query)
+        if use_cache:
+            cached = await sql_result_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Query result served from cache")
+                return cached
+
+        execution_id, error = await submit_and_wait(sql_query, poller, on_progress)
+        if error:
+            return {'Error': error}
+
+        with phase_seconds.time(phase="fetch"), span("chainbase.get_results", execution_id=execution_id):
+            results = await get_results(execution_id)
+        if 'Error' in results:
+            return results
+        data = results['data']
+        if 'data' in data:
+            if data['data']:
+                columns = data['columns']
+                internal_data = data['data']
+                logger.info("Fetched results", extra={'columns': len(columns), 'rows': len(internal_data)})
+                result = {'Columns': columns, 'Data': internal_data}
+                if use_cache:
+                    await sql_result_cache.set(cache_key, result)
+                return result
+
+            else:
+                message = data['message']
+                logger.info("Results: %s", Truncated(message))
+                return {'Error': message}
 
     except Exception as e:
-        logging.error(f"An error occurred: {e}")
+        logger.error("An error occurred: %s", e)
         return {'Error': f"An error occurred: {e}"}
+
+
+# Function to fetch a preview of a query and count its rows
+async def execute_preview_query(query, max_column=MAX_COLUMN_SHOW, max_row=MAX_ROW_SHOW,
+                                poller=None, on_progress=None):
+    """
+    Fetch only the rows and columns a preview shows, and count the full result separately.
+
+    The LIMIT is pushed into the SQL sent upstream, and the COUNT query runs
+    concurrently with it, so large results are never downloaded. The count stops
+    at SCAN_COUNT_CAP rows, as even a filtered scan of a large table may match most of it.
+
+    Returns:
+    - {'Columns': first `max_column` columns, 'Data': first `max_row` rows,
+      'TotalColumns': int, 'TotalRows': int, "N+" when the capped count was reached,
+      or None if the count failed}, or the error result of the preview query.
+    """
+    response, counted = await asyncio.gather(
+        execute_query_and_fetch_results(preview_query(query, max_row), poller, on_progress),
+        execute_query_and_fetch_results(count_query(query, SCAN_COUNT_CAP)))
+    if not response or 'Data' not in response:
+        return response
+
+    total_rows = None
+    if counted and 'Data' in counted:
+        total_rows = int(counted['Data'][0][0])
+        if total_rows >= SCAN_COUNT_CAP:
+            total_rows = f"{SCAN_COUNT_CAP}+"
+    else:
+        logger.info("Row count failed: %s", Truncated(counted))
+
+    return {
+        'Columns': response['Columns'][:max_column],
+        'Data': [row[:max_column] for row in response['Data']],
+        'TotalColumns': len(response['Columns']),
+        'TotalRows': total_rows,
+    }
+
+
+# Function to download the results of the query execution to a file without parsing them
+async def download_results(execution_id, file, max_bytes=SQL_EXPORT_MAX_BYTES):
+    """
+    Stream the raw results JSON into `file` chunk by chunk, giving up once more than
+    `max_bytes` have been written to disk.
+
+    Returns:
+    - None on success, or an error message.
+    """
+    headers = {
+        "X-API-KEY": CHAINBASE_API_KEY,
+        "Content-Type": "application/json"
+    }
+
+    try:
+        with phase_seconds.time(phase="fetch"), span("chainbase.download_results", execution_id=execution_id):
+            async with limited_request('sql_results', 'GET', f"{CHAINBASE_API_URL}/execution/{execution_id}/results",
+                                       headers=headers, timeout=TIMEOUT) as response:
+                written = 0
+                async for chunk in response.content.iter_chunked(SQL_EXPORT_CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > max_bytes:
+                        return f"Result is larger than {max_bytes // (1024 * 1024)} MB"
+                    await asyncio.to_thread(file.write, chunk)
+                return None
+    except Exception as e:
+        logger.error("Failed to download results: %s", e)
+        return f"Failed to download results: {e}"
+
+
+def iter_result_rows(file):
+    """
+    Incrementally parse a downloaded results file.
+
+    Returns:
+    - (column names, `ResultRows`), or (None, error message) when there is no data.
+    """
+    file.seek(0)
+    columns = []
+    # Stop at the end of the columns array instead of parsing the rows after it
+    for prefix, event, value in ijson.parse(file):
+        if prefix == 'data.columns.item.name':
+            columns.append(value)
+        elif prefix == 'data.columns' and event == 'end_array':
+            break
+    if not columns:
+        file.seek(0)
+        message = next(ijson.items(file, 'data.message'), None) or "No data found in results"
+        return None, message
+
+    return columns, ResultRows(file)
+
+
+class ResultRows:
+    """Rows of a downloaded results file, parsed again from the start on every iteration."""
+
+    def __init__(self, file):
+        self.file = file
+        self.backend = ijson
+
+    def __iter__(self):
+        yielded = 0
+        while True:
+            self.file.seek(0)
+            rows = self.backend.items(self.file, 'data.data.item', use_float=True)
+            try:
+                for row in itertools.islice(rows, yielded, None):
+                    yielded += 1
+                    yield row
+                return
+            except ijson.common.IncompleteJSONError as e:
+                if self.backend is not ijson or 'overflow' not in str(e):
+                    raise
+                # The C parser cannot hold integers beyond 64 bits (e.g. amounts in wei),
+                # continue after the rows already read with the slower pure Python one
+                self.backend = ijson.get_backend('python')
+
+
+async def execute_query_and_stream_results(query, file, poller=None, on_progress=None):
+    """
+    Execute a query and stream its results into `file` for exports too large to hold in memory.
+
+    Returns:
+    - (column names, rows) or (None, error message).
+    The rows are read from `file` lazily, on every iteration, and are meant to be consumed off the event loop.
+    """
+    try:
+        execution_id, error = await submit_and_wait(query, poller, on_progress)
+        if error:
+            return None, error
+
+        error = await download_results(execution_id, file)
+        if error:
+            return None, error
+
+        return await asyncio.to_thread(iter_result_rows, file)
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+        return None, f"An error occurred: {e}"
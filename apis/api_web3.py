@@ -1,11 +1,20 @@
 import aiohttp
 import asyncio
+import codecs
+import json
 import logging
 
-from config import CHAINBASE_API_WEB3_URL, CHAINBASE_API_KEY, API_TIMEOUT, FLOCK_AUTH_TOKEN
+from config import (CHAINBASE_API_WEB3_URL, CHAINBASE_API_KEY, API_TIMEOUT, FLOCK_AUTH_TOKEN,
+                    WEB3_CACHE_MAX_BYTES, WEB3_CACHE_DB, WEB3_PRICE_TTL, WEB3_LATEST_TTL, WEB3_ENS_TTL,
+                    WEB3_FINALITY_BLOCKS, AI_TOP_K_TABLES, AI_STREAM, AI_CACHE_TTL, AI_CACHE_MAX_BYTES, AI_CACHE_DB,
+                    AI_CACHE_MAX_ENTRIES, AI_CACHE_SIMILARITY)
+from apis.cache import TTLCache, SQLiteStore, SimilarityIndex, cached, normalize_question
+from apis.rate_limit import limited_request
+from apis.singleflight import single_flight
+from logs import Truncated
+from catalog import build_system_prompt, catalog_schemas, catalog_words, CHAIN_ALIASES
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # Load the system prompt from the file
 system_prompt_file = "apis/system_prompt_with_table_data.txt"
@@ -17,10 +26,85 @@ with open(system_prompt_file, "r") as f:
 # Timeout for API requests
 TIMEOUT = aiohttp.ClientTimeout(total=API_TIMEOUT)
 TIMEOUT_FOR_AI = aiohttp.ClientTimeout(total=40)
+# A streamed answer may take longer overall, as long as it keeps arriving
+TIMEOUT_FOR_AI_STREAM = aiohttp.ClientTimeout(total=API_TIMEOUT, sock_read=40)
 
+# Cache for Web3 lookups; entries without a TTL stay until evicted
+web3_cache = TTLCache("web3", WEB3_CACHE_MAX_BYTES,
+                      store=SQLiteStore(WEB3_CACHE_DB, "web3") if WEB3_CACHE_DB else None)
+
+# Answers of /ask_ai keyed on the normalized question, with an index to find similar questions
+ai_answer_cache = TTLCache("ai_answers", AI_CACHE_MAX_BYTES, default_ttl=AI_CACHE_TTL,
+                           store=SQLiteStore(AI_CACHE_DB, "ai_answers") if AI_CACHE_DB else None)
+ai_question_index = SimilarityIndex(AI_CACHE_MAX_ENTRIES, keywords=catalog_schemas | set(CHAIN_ALIASES),
+                                    vocabulary=catalog_words)
+_question_index_loaded = False
+
+
+def is_successful(response):
+    """Only cache successful upstream responses, never errors."""
+    return (isinstance(response, dict) and response.get('code') in (0, 200)
+            and response.get('data') not in (None, "null"))
+
+
+def parse_block_number(value):
+    """Return a block number given as an int, a decimal or a 0x-prefixed hex string, or None."""
+    try:
+        value = str(value)
+        return int(value, 16) if value.startswith("0x") else int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _data_field(result, name):
+    data = result.get('data')
+    return data.get(name) if isinstance(data, dict) else None
+
+
+# Function to fetch the number of the latest block of a chain
+@cached(web3_cache, ttl=WEB3_LATEST_TTL, when=is_successful)
+@single_flight
+async def api_get_latest_block_number(chain_id):
+    headers = {
+        "x-api-key": CHAINBASE_API_KEY,
+    }
+    querystring = {
+        "chain_id": chain_id,
+    }
+
+    try:
+        async with limited_request('web3', 'GET', f"{CHAINBASE_API_WEB3_URL}/block/number/latest", headers=headers,
+                                   params=querystring, timeout=TIMEOUT) as response:
+            return await response.json()
+    except asyncio.TimeoutError:
+        logger.error("Request timed out while fetching the latest block number")
+        return {'Error': "Request timed out while fetching the latest block number"}
+    except Exception as e:
+        logger.error("Failed to fetch the latest block number: %s", e)
+        return {'Error': f"Failed to fetch the latest block number: {e}"}
+
+
+async def block_ttl(block, chain_id):
+    """
+    Finalized blocks never change and are kept until evicted. "latest" (or anything
+    non-numeric, such as the block of a pending transaction), blocks within
+    WEB3_FINALITY_BLOCKS of the chain head, and blocks of a chain whose head could
+    not be fetched may still be reorged, so they are only kept briefly.
+    """
+    number = parse_block_number(block) if block not in (None, "", "latest") else None
+    if number is None:
+        return WEB3_LATEST_TTL
+    # The head is itself cached for WEB3_LATEST_TTL, so bulk lookups fetch it once
+    latest = await api_get_latest_block_number(chain_id)
+    head = parse_block_number(_data_field(latest, 'number')) if is_successful(latest) else None
+    if head is None or number > head - WEB3_FINALITY_BLOCKS:
+        return WEB3_LATEST_TTL
+    return None
 
 
 # Function to fetch block details
+@cached(web3_cache, ttl=lambda result, number, chain_id: block_ttl(number, chain_id), when=is_successful)
+@single_flight
 async def api_get_block_by_number(number, chain_id):
     headers = {
         "x-api-key": CHAINBASE_API_KEY,
@@ -30,20 +114,23 @@ async def api_get_block_by_number(number, chain_id):
         "chain_id": chain_id,
     }
 
-    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-        try:
-            async with session.get(f"{CHAINBASE_API_WEB3_URL}/block/detail", headers=headers,
-                                   params=querystring) as response:
-                return await response.json()
-        except asyncio.TimeoutError:
-            logging.error("Request timed out while fetching block details")
-            return {'Error': "Request timed out while fetching block details"}
-        except Exception as e:
-            logging.error(f"Failed to fetch block details: {e}")
-            return {'Error': f"Failed to fetch block details: {e}"}
-
-
-# Function to fetch transaction details
+    try:
+        async with limited_request('web3', 'GET', f"{CHAINBASE_API_WEB3_URL}/block/detail", headers=headers,
+                                   params=querystring, timeout=TIMEOUT) as response:
+            return await response.json()
+    except asyncio.TimeoutError:
+        logger.error("Request timed out while fetching block details")
+        return {'Error': "Request timed out while fetching block details"}
+    except Exception as e:
+        logger.error("Failed to fetch block details: %s", e)
+        return {'Error': f"Failed to fetch block details: {e}"}
+
+
+# Function to fetch transaction details (pending and recent transactions are only kept briefly)
+@cached(web3_cache, when=is_successful,
+        ttl=lambda result, tx_hash, chain_id, block_number, tx_index:
+        block_ttl(_data_field(result, 'block_number'), chain_id))
+@single_flight
 async def api_get_transaction(tx_hash, chain_id, block_number=None, tx_index=None):
     headers = {
         "x-api-key": CHAINBASE_API_KEY,
@@ -55,20 +142,22 @@ async def api_get_transaction(tx_hash, chain_id, block_number=None, tx_index=Non
         "tx_index": tx_index if tx_index is not None else ""
     }
 
-    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-        try:
-            async with session.get(f"{CHAINBASE_API_WEB3_URL}/tx/detail", headers=headers,
-                                   params=querystring) as response:
-                return await response.json()
-        except asyncio.TimeoutError:
-            logging.error("Request timed out while fetching transaction details")
-            return {'Error': "Request timed out while fetching transaction details"}
-        except Exception as e:
-            logging.error(f"Failed to fetch transaction details: {e}")
-            return {'Error': f"Failed to fetch transaction details: {e}"}
+    try:
+        async with limited_request('web3', 'GET', f"{CHAINBASE_API_WEB3_URL}/tx/detail", headers=headers,
+                                   params=querystring, timeout=TIMEOUT) as response:
+            return await response.json()
+    except asyncio.TimeoutError:
+        logger.error("Request timed out while fetching transaction details")
+        return {'Error': "Request timed out while fetching transaction details"}
+    except Exception as e:
+        logger.error("Failed to fetch transaction details: %s", e)
+        return {'Error': f"Failed to fetch transaction details: {e}"}
 
 
 # Function to fetch native token balances
+@cached(web3_cache, ttl=lambda result, address, chain_id, to_block: block_ttl(to_block, chain_id),
+        when=is_successful)
+@single_flight
 async def api_get_native_token_balance(address, chain_id, to_block="latest"):
     headers = {
         "x-api-key": CHAINBASE_API_KEY,
@@ -79,20 +168,21 @@ async def api_get_native_token_balance(address, chain_id, to_block="latest"):
         "to_block": to_block,
     }
 
-    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-        try:
-            async with session.get(f"{CHAINBASE_API_WEB3_URL}/account/balance", headers=headers,
-                                   params=querystring) as response:
-                return await response.json()
-        except asyncio.TimeoutError:
-            logging.error("Request timed out while fetching native token balance")
-            return {'Error': "Request timed out while fetching native token balance"}
-        except Exception as e:
-            logging.error(f"Failed to fetch native token balance: {e}")
-            return {'Error': f"Failed to fetch native token balance: {e}"}
+    try:
+        async with limited_request('web3', 'GET', f"{CHAINBASE_API_WEB3_URL}/account/balance", headers=headers,
+                                   params=querystring, timeout=TIMEOUT) as response:
+            return await response.json()
+    except asyncio.TimeoutError:
+        logger.error("Request timed out while fetching native token balance")
+        return {'Error': "Request timed out while fetching native token balance"}
+    except Exception as e:
+        logger.error("Failed to fetch native token balance: %s", e)
+        return {'Error': f"Failed to fetch native token balance: {e}"}
 
 
 # Function to fetch token metadata
+@cached(web3_cache, when=is_successful)
+@single_flight
 async def api_get_token_metadata(contract_address, chain_id):
     headers = {
         "x-api-key": CHAINBASE_API_KEY,
@@ -102,20 +192,21 @@ async def api_get_token_metadata(contract_address, chain_id):
         "chain_id": chain_id,
     }
 
-    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-        try:
-            async with session.get(f"{CHAINBASE_API_WEB3_URL}/token/metadata", headers=headers,
-                                   params=querystring) as response:
-                return await response.json()
-        except asyncio.TimeoutError:
-            logging.error("Request timed out while fetching token metadata")
-            return {'Error': "Request timed out while fetching token metadata"}
-        except Exception as e:
-            logging.error(f"Failed to fetch token metadata: {e}")
-            return {'Error': f"Failed to fetch token metadata: {e}"}
+    try:
+        async with limited_request('web3', 'GET', f"{CHAINBASE_API_WEB3_URL}/token/metadata", headers=headers,
+                                   params=querystring, timeout=TIMEOUT) as response:
+            return await response.json()
+    except asyncio.TimeoutError:
+        logger.error("Request timed out while fetching token metadata")
+        return {'Error': "Request timed out while fetching token metadata"}
+    except Exception as e:
+        logger.error("Failed to fetch token metadata: %s", e)
+        return {'Error': f"Failed to fetch token metadata: {e}"}
 
 
 # Function to fetch token price
+@cached(web3_cache, ttl=WEB3_PRICE_TTL, when=is_successful)
+@single_flight
 async def api_get_token_price(contract_address, chain_id):
     headers = {
         "x-api-key": CHAINBASE_API_KEY,
@@ -125,20 +216,21 @@ async def api_get_token_price(contract_address, chain_id):
         "chain_id": chain_id,
     }
 
-    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-        try:
-            async with session.get(f"{CHAINBASE_API_WEB3_URL}/token/price", headers=headers,
-                                   params=querystring) as response:
-                return await response.json()
-        except asyncio.TimeoutError:
-            logging.error("Request timed out while fetching token price")
-            return {'Error': "Request timed out while fetching token price"}
-        except Exception as e:
-            logging.error(f"Failed to fetch token price: {e}")
-            return {'Error': f"Failed to fetch token price: {e}"}
+    try:
+        async with limited_request('web3', 'GET', f"{CHAINBASE_API_WEB3_URL}/token/price", headers=headers,
+                                   params=querystring, timeout=TIMEOUT) as response:
+            return await response.json()
+    except asyncio.TimeoutError:
+        logger.error("Request timed out while fetching token price")
+        return {'Error': "Request timed out while fetching token price"}
+    except Exception as e:
+        logger.error("Failed to fetch token price: %s", e)
+        return {'Error': f"Failed to fetch token price: {e}"}
 
 
 # Function to fetch NFT metadata
+@cached(web3_cache, when=is_successful)
+@single_flight
 async def api_get_nft_metadata(contract_address, nft_id, chain_id):
     headers = {
         "x-api-key": CHAINBASE_API_KEY,
@@ -149,20 +241,23 @@ async def api_get_nft_metadata(contract_address, nft_id, chain_id):
         "chain_id": chain_id,
     }
 
-    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-        try:
-            async with session.get(f"{CHAINBASE_API_WEB3_URL}/nft/metadata", headers=headers,
-                                   params=querystring) as response:
-                return await response.json()
-        except asyncio.TimeoutError:
-            logging.error("Request timed out while fetching NFT metadata")
-            return {'Error': "Request timed out while fetching NFT metadata"}
-        except Exception as e:
-            logging.error(f"Failed to fetch NFT metadata: {e}")
-            return {'Error': f"Failed to fetch NFT metadata: {e}"}
+    try:
+        async with limited_request('web3', 'GET', f"{CHAINBASE_API_WEB3_URL}/nft/metadata", headers=headers,
+                                   params=querystring, timeout=TIMEOUT) as response:
+            return await response.json()
+    except asyncio.TimeoutError:
+        logger.error("Request timed out while fetching NFT metadata")
+        return {'Error': "Request timed out while fetching NFT metadata"}
+    except Exception as e:
+        logger.error("Failed to fetch NFT metadata: %s", e)
+        return {'Error': f"Failed to fetch NFT metadata: {e}"}
 
 
 # Function to resolve ENS domain
+@cached(web3_cache, when=is_successful,
+        ttl=lambda result, domain, chain_id, to_block:
+        block_ttl(to_block, chain_id) if str(to_block).isdigit() else WEB3_ENS_TTL)
+@single_flight
 async def api_resolve_ens_domain(domain, chain_id, to_block="latest"):
     headers = {
         "x-api-key": CHAINBASE_API_KEY,
@@ -173,55 +268,174 @@ async def api_resolve_ens_domain(domain, chain_id, to_block="latest"):
         "to_block": to_block,
     }
 
-    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-        try:
-            async with session.get(f"{CHAINBASE_API_WEB3_URL}/ens/records", headers=headers,
-                                   params=querystring) as response:
-                return await response.json()
-        except asyncio.TimeoutError:
-            logging.error("Request timed out while resolving ENS domain")
-            return {'Error': "Request timed out while resolving ENS domain"}
-        except Exception as e:
-            logging.error(f"Failed to resolve ENS domain: {e}")
-            return {'Error': f"Failed to resolve ENS domain: {e}"}
+    try:
+        async with limited_request('web3', 'GET', f"{CHAINBASE_API_WEB3_URL}/ens/records", headers=headers,
+                                   params=querystring, timeout=TIMEOUT) as response:
+            return await response.json()
+    except asyncio.TimeoutError:
+        logger.error("Request timed out while resolving ENS domain")
+        return {'Error': "Request timed out while resolving ENS domain"}
+    except Exception as e:
+        logger.error("Failed to resolve ENS domain: %s", e)
+        return {'Error': f"Failed to resolve ENS domain: {e}"}
+
+
+# Function to read a streamed AI answer
+async def read_ai_stream(response, on_chunk=None):
+    """
+    Collect an answer streamed as server-sent events or as chunked plain text.
+
+    Each event's `data` is either JSON with a `content` (or `delta`) string, or the text itself.
+
+    Parameters:
+    - response: The streaming response.
+    - on_chunk: Optional coroutine `on_chunk(text)` called with each new piece of the answer.
+
+    Returns:
+    - str: The whole answer.
+    """
+    parts = []
+
+    async def add(text):
+        if text:
+            parts.append(text)
+            if on_chunk is not None:
+                await on_chunk(text)
+
+    if response.content_type == "text/event-stream":
+        # An event is the `data` lines up to a blank line, joined with newlines; an event
+        # cut off by the end of the stream is not dispatched
+        data_lines = []
+        async for raw_line in response.content:
+            line = raw_line.decode("utf-8").rstrip("\r\n")
+            if not line:
+                if not data_lines:
+                    continue
+                data = "\n".join(data_lines)
+                data_lines = []
+                if data == "[DONE]":
+                    break
+                try:
+                    payload = json.loads(data)
+                except ValueError:
+                    payload = data
+                if isinstance(payload, dict):
+                    payload = payload.get("content") or payload.get("delta") or ""
+                await add(str(payload))
+                continue
+            field, _, value = line.partition(":")
+            if field == "data":
+                data_lines.append(value[1:] if value.startswith(" ") else value)
+    else:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        async for chunk in response.content.iter_any():
+            await add(decoder.decode(chunk))
+        await add(decoder.decode(b"", final=True))
+    return "".join(parts)
+
 
 # Function to interact with AI API for help users
-async def api_flock_ai(user_query, system_prompt=system_prompt_for_ai):
+# (not coalesced itself: identical questions are coalesced by api_flock_ai_cached)
+async def api_flock_ai(user_query, system_prompt=None, on_chunk=None):
+    """
+    Ask the AI a question.
+
+    With AI_STREAM the endpoint is asked to stream its answer, and `on_chunk(text)` is
+    awaited with each new piece; a plain JSON answer is accepted too.
+
+    Returns:
+    - str: The answer, or {'Error': message}.
+    """
     api_url = "https://vatsalkshah--flock-chainbase-task-model-api.modal.run/inference"
 
+    # Send only the tables relevant to the question instead of the whole catalog
+    if system_prompt is None:
+        system_prompt = build_system_prompt(user_query) if AI_TOP_K_TABLES else system_prompt_for_ai
+
     # Request body in JSON format
     json_body = {
         "system_prompt": system_prompt,
         "content": user_query
     }
+    if AI_STREAM:
+        json_body["stream"] = True
 
     # Headers with Authorization token
     headers = {
         "Authorization": f"Bearer {FLOCK_AUTH_TOKEN}",
         "Content-Type": "application/json",
-        "accept": "application/json"
-    }
-
-    async with aiohttp.ClientSession(timeout=TIMEOUT_FOR_AI) as session:
-        try:
-            # Send POST request with JSON body and headers
-            async with session.post(api_url, json=json_body, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if "content" in data:
-                        return data["content"]
-                    else:
-                        logging.error("Response does not contain 'content' key")
-                        return {'Error': "Response does not contain 'content' key"}
-                else:
-                    # Log the full response details for debugging
-                    logging.error(f"Unexpected response status: {response.status}")
-                    logging.error(await response.text())  # Log body for further debugging
-                    return {'Error': f"Unexpected response status: {response.status}"}
-        except asyncio.TimeoutError:
-            logging.error("Request timed out while generating SQL query")
-            return {'Error': "Request timed out while generating SQL query"}
-        except Exception as e:
-            logging.error(f"Failed to generate SQL query: {e}")
-            return {'Error': f"Failed to generate SQL query: {e}"}
+        "accept": "text/event-stream, application/json" if AI_STREAM else "application/json"
+    }
 
+    try:
+        # Send POST request with JSON body and headers
+        async with limited_request('flock_ai', 'POST', api_url, json=json_body, headers=headers,
+                                   timeout=TIMEOUT_FOR_AI_STREAM if AI_STREAM else TIMEOUT_FOR_AI) as response:
+            if response.status == 200 and response.content_type in ("text/event-stream", "text/plain"):
+                return await read_ai_stream(response, on_chunk)
+            elif response.status == 200:
+                data = await response.json()
+                if "content" in data:
+                    return data["content"]
+                else:
+                    logger.error("Response does not contain 'content' key")
+                    return {'Error': "Response does not contain 'content' key"}
+            else:
+                # Log the full response details for debugging
+                logger.error("Unexpected response status: %s", response.status)
+                logger.error("Response body: %s", Truncated(await response.text()))  # Log body for further debugging
+                return {'Error': f"Unexpected response status: {response.status}"}
+    except asyncio.TimeoutError:
+        logger.error("Request timed out while generating SQL query")
+        return {'Error': "Request timed out while generating SQL query"}
+    except Exception as e:
+        logger.error("Failed to generate SQL query: %s", e)
+        return {'Error': f"Failed to generate SQL query: {e}"}
+
+
+# Function to rebuild the question index from the on-disk answer cache
+async def load_question_index():
+    global _question_index_loaded
+    if _question_index_loaded:
+        return
+    _question_index_loaded = True
+    if ai_answer_cache.store is not None:
+        rows = await asyncio.to_thread(ai_answer_cache.store.items)
+        for key, value in rows:
+            ai_question_index.add(key, json.loads(value)['question'])
+        logger.info("Loaded %d cached questions", len(ai_question_index))
+
+
+# Function to answer from the cache when the same or a similar question was asked before
+@single_flight(key=lambda user_query, on_chunk=None: normalize_question(user_query))
+async def api_flock_ai_cached(user_query, on_chunk=None):
+    """
+    Answer a question through `api_flock_ai`, reusing the answer of an identical
+    (after normalization) or similar enough (`AI_CACHE_SIMILARITY`) earlier question.
+
+    `on_chunk` is passed to `api_flock_ai` to receive a fresh answer as it streams.
+
+    Returns:
+    - (answer, hit): `hit` is None for a fresh answer, or a dict with the `match`
+      ("exact" or "similar"), the earlier `question` and its `similarity`.
+    """
+    await load_question_index()
+    key = normalize_question(user_query)
+    entry = await ai_answer_cache.get(key)
+    if entry is not None:
+        return entry['answer'], {'match': "exact", 'question': entry['question'], 'similarity': 1.0}
+
+    for similarity, match_key in ai_question_index.search(user_query, AI_CACHE_SIMILARITY):
+        entry = await ai_answer_cache.get(match_key)
+        if entry is None:  # Expired or evicted
+            ai_question_index.remove(match_key)
+            continue
+        logger.info("Answered from a similar question (%.2f)", similarity)
+        return entry['answer'], {'match': "similar", 'question': entry['question'], 'similarity': similarity}
+
+    answer = await api_flock_ai(user_query, on_chunk=on_chunk)
+    # Only real answers are cached, errors come back as dicts
+    if isinstance(answer, str) and answer:
+        await ai_answer_cache.set(key, {'question': user_query, 'answer': answer})
+        ai_question_index.add(key, user_query)
+    return answer, None
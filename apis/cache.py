@@ -0,0 +1,314 @@
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import math
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, Counter as TermCounter
+
+from metrics import Counter, Gauge
+
+
+def normalize_sql(query):
+    """
+    Normalize an SQL query so equivalent queries share a cache key.
+
+    Whitespace is collapsed, unquoted text is lowercased (keywords and
+    identifiers are case-insensitive) and trailing semicolons are dropped.
+    Quoted literals and identifiers are kept as they are.
+    """
+    parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", query.strip())
+    normalized = []
+    for i, part in enumerate(parts):
+        if i % 2:
+            normalized.append(part)  # Quoted literal
+        else:
+            normalized.append(re.sub(r"\s+", " ", part).lower())
+    return "".join(normalized).strip().rstrip(";").strip()
+
+
+def normalize_question(question):
+    """Lowercase a question and drop punctuation and extra whitespace, so trivial rewordings share a key."""
+    return " ".join(re.findall(r"[a-z0-9]+", question.lower()))
+
+
+class SQLiteStore:
+    """Optional on-disk tier for `TTLCache` so entries survive restarts."""
+
+    def __init__(self, path, table="cache"):
+        if not re.fullmatch(r"\w+", table):
+            raise ValueError(f"Invalid table name: {table}")
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                               f"(key TEXT PRIMARY KEY, value TEXT, expires_at REAL)")
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?",
+                                     (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return None
+        return value, expires_at
+
+    def set(self, key, value, expires_at):
+        with self._lock, self._conn:
+            self._conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                               (key, value, expires_at))
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def items(self):
+        """Return the (key, value) pairs that have not expired."""
+        with self._lock:
+            return self._conn.execute(f"SELECT key, value FROM {self.table} "
+                                      f"WHERE expires_at IS NULL OR expires_at > ?", (time.time(),)).fetchall()
+
+
+# Every TTLCache, for the metrics
+caches = []
+
+
+class TTLCache:
+    """
+    In-memory LRU cache with per-entry TTLs, bounded by the serialized size of
+    the cached values, with an optional `SQLiteStore` behind it.
+
+    A `ttl` of None means the entry never expires.
+    """
+
+    def __init__(self, name, max_bytes, default_ttl=None, store=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.store = store
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        caches.append(self)
+
+    def _get_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at, size = entry
+        if expires_at is not None and expires_at <= time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def _set_memory(self, key, value, expires_at, size):
+        if key in self._entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            return  # Too big to keep in memory
+        self._entries[key] = (value, expires_at, size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    async def get(self, key):
+        """Return the cached value or None on a miss."""
+        entry = self._get_memory(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[0]
+
+        if self.store is not None:
+            try:
+                row = await asyncio.to_thread(self.store.get, key)
+            except Exception as e:
+                logging.error("Failed to read %s cache from disk: %s", self.name, e)
+                row = None
+            if row is not None:
+                serialized, expires_at = row
+                value = json.loads(serialized)
+                self._set_memory(key, value, expires_at, len(serialized))
+                self.disk_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    async def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        serialized = json.dumps(value)
+        self._set_memory(key, value, expires_at, len(serialized))
+
+        if self.store is not None:
+            try:
+                await asyncio.to_thread(self.store.set, key, serialized, expires_at)
+            except Exception as e:
+                logging.error("Failed to write %s cache to disk: %s", self.name, e)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Words that do not change what a question asks for
+STOP_WORDS = frozenset("""
+    a an the i me my we you to of in on for from with by at and or is are was be do does did can could
+    how what whats which who s it its this that these those please show give get find list all any some
+""".split())
+
+# Words describing what is asked rather than what it is asked about
+COMMON_WORDS = frozenset("""
+    top largest biggest most highest lowest smallest least recent latest last first new many much
+    number count total average avg sum daily weekly monthly per day days week weeks month months
+    year years hour hours today yesterday ago past over between since than more less
+    query sql table data value volume amount holder holders rank ranked ranking sorted order
+""".split())
+
+
+class SimilarityIndex:
+    """
+    TF-IDF cosine similarity over short texts, to find the cached entry of a near-duplicate question.
+
+    Terms are the words of the normalized text without stop words. Words containing
+    digits (addresses, hashes, block numbers), `keywords` (e.g. chain names) and words
+    outside COMMON_WORDS and `vocabulary` (token symbols, project names) must all match
+    for two texts to be compared. Holds at most `max_entries` texts, dropping the oldest first.
+    """
+
+    def __init__(self, max_entries, keywords=frozenset(), vocabulary=frozenset()):
+        self.max_entries = max_entries
+        self.keywords = keywords
+        self.vocabulary = COMMON_WORDS | vocabulary
+        self._entries = OrderedDict()  # key -> (term counts, literal words)
+        self._postings = {}  # term -> set of keys
+
+    def _terms(self, text):
+        words = [word for word in normalize_question(text).split() if word not in STOP_WORDS]
+        literals = frozenset(word for word in words if self._is_literal(word))
+        return TermCounter(words), literals
+
+    def _is_literal(self, word):
+        if word in self.keywords or any(char.isdigit() for char in word):
+            return True
+        return word not in self.vocabulary and not (word.endswith("s") and word[:-1] in self.vocabulary)
+
+    def _idf(self, term):
+        return math.log((1 + len(self._entries)) / (1 + len(self._postings.get(term, ())))) + 1
+
+    def _vector(self, terms):
+        vector = {term: count * self._idf(term) for term, count in terms.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {term: weight / norm for term, weight in vector.items()}
+
+    def add(self, key, text):
+        self.remove(key)
+        terms, literals = self._terms(text)
+        self._entries[key] = (terms, literals)
+        for term in terms:
+            self._postings.setdefault(term, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self.remove(next(iter(self._entries)))
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for term in entry[0]:
+            keys = self._postings[term]
+            keys.discard(key)
+            if not keys:
+                del self._postings[term]
+
+    def search(self, text, threshold):
+        """Return (similarity, key) pairs of at least `threshold`, most similar first."""
+        terms, literals = self._terms(text)
+        query = self._vector(terms)
+        candidates = set()
+        for term in terms:
+            candidates |= self._postings.get(term, set())
+
+        matches = []
+        for key in candidates:
+            entry_terms, entry_literals = self._entries[key]
+            if entry_literals != literals:
+                continue
+            vector = self._vector(entry_terms)
+            similarity = sum(weight * vector.get(term, 0.0) for term, weight in query.items())
+            if similarity >= threshold:
+                matches.append((similarity, key))
+        return sorted(matches, reverse=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _cache_samples(field):
+    return lambda: [({"cache": cache.name}, cache.stats()[field]) for cache in caches]
+
+
+Counter("cache_hits_total", "Cache hits served from memory", collect=_cache_samples("hits"))
+Counter("cache_disk_hits_total", "Cache hits served from the on-disk store", collect=_cache_samples("disk_hits"))
+Counter("cache_misses_total", "Cache misses", collect=_cache_samples("misses"))
+Counter("cache_evictions_total", "Entries evicted to stay within the memory budget",
+        collect=_cache_samples("evictions"))
+Gauge("cache_bytes", "Serialized size of the entries held in memory", collect=_cache_samples("bytes"))
+
+
+def cached(cache, ttl=None, when=None):
+    """
+    Decorator caching the results of an async function in a `TTLCache`.
+
+    Parameters:
+    - cache: The `TTLCache` to use.
+    - ttl: Seconds to keep a result, None to keep it until evicted, or a (sync or async)
+      function `ttl(result, **call arguments)` returning one of those.
+    - when: Optional predicate on the result; only matching results are cached.
+    """
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = f"{f.__qualname__}:{json.dumps(bound.arguments, sort_keys=True, default=str)}"
+
+            value = await cache.get(key)
+            if value is not None:
+                return value
+
+            value = await f(*args, **kwargs)
+            if when is None or when(value):
+                entry_ttl = ttl(value, **bound.arguments) if callable(ttl) else ttl
+                if inspect.isawaitable(entry_ttl):
+                    entry_ttl = await entry_ttl
+                await cache.set(key, value, ttl=entry_ttl)
+            return value
+        return wrapper
+    return decorator
@@ -0,0 +1,48 @@
+import aiohttp
+import logging
+
+from config import (HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_DNS_CACHE_TTL,
+                    HTTP_KEEPALIVE_TIMEOUT, API_TIMEOUT)
+
+# Shared session used by every Chainbase and AI call
+_session = None
+
+
+def _create_session():
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=API_TIMEOUT))
+
+
+# Function to start the shared session (called from MyClient.setup_hook)
+async def start_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+        logging.info("HTTP session started")
+    return _session
+
+
+# Function to close the shared session on shutdown
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logging.info("HTTP session closed")
+    _session = None
+
+
+def get_session():
+    """
+    Return the shared aiohttp session, creating it lazily if the bot
+    has not started it yet (e.g. when the APIs are used from a script).
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
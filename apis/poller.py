@@ -0,0 +1,55 @@
+import asyncio
+import random
+import time
+
+from config import SQL_POLL_FIRST_DELAY, SQL_POLL_BASE_DELAY, SQL_POLL_MAX_DELAY, SQL_POLL_DEADLINE
+
+
+class BackoffPoller:
+    """
+    Polling strategy for long-running upstream jobs.
+
+    The first probe happens after a short delay so fast queries return quickly,
+    later probes back off exponentially (with jitter) up to `max_delay`, and the
+    whole loop stops once `deadline` seconds of wall-clock time have passed.
+
+    Any object with the same `wait()` / `expired` / `elapsed` interface can be
+    passed to `execute_query_and_fetch_results` instead.
+    """
+
+    def __init__(self, first_delay=SQL_POLL_FIRST_DELAY, base_delay=SQL_POLL_BASE_DELAY,
+                 max_delay=SQL_POLL_MAX_DELAY, deadline=SQL_POLL_DEADLINE, factor=2.0, jitter=0.2):
+        self.first_delay = first_delay
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+        self.started_at = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    @property
+    def expired(self):
+        return self.elapsed >= self.deadline
+
+    def next_delay(self):
+        """Return the delay before the next probe, without sleeping."""
+        if self.attempts == 0:
+            delay = self.first_delay
+        else:
+            delay = min(self.base_delay * self.factor ** (self.attempts - 1), self.max_delay)
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        # Never sleep past the deadline
+        return max(0.0, min(delay, self.deadline - self.elapsed))
+
+    async def wait(self):
+        """Sleep until the next probe. Returns False once the deadline has passed."""
+        if self.expired:
+            return False
+        await asyncio.sleep(self.next_delay())
+        self.attempts += 1
+        return True
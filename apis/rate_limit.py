@@ -0,0 +1,170 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+from email.utils import parsedate_to_datetime
+
+from config import RATE_LIMITS, RATE_LIMIT_MAX_RETRIES
+from apis.http_client import get_session
+from metrics import (Counter, Gauge, upstream_seconds, upstream_requests, upstream_errors,
+                     upstream_retries)
+
+# Lower values are served first when requests are queued
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class RateLimitedError(Exception):
+    pass
+
+
+class UpstreamLimiter:
+    """
+    Token-bucket rate limiter combined with a concurrency cap.
+
+    Waiting requests are served by priority, then in arrival order, so cheap
+    interactive lookups are not starved behind bulk work. `pause()` stops all
+    requests for a while, e.g. when the upstream answers with Retry-After.
+    """
+
+    def __init__(self, name, rate, burst, concurrency):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.tokens = burst
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.throttled = 0
+        self._updated_at = time.monotonic()
+        self._waiters = []  # heap of (priority, sequence, future)
+        self._sequence = itertools.count()
+        self._timer = None
+
+    @property
+    def queued(self):
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def _wake(self):
+        self._timer = None
+        while self._waiters and self.in_flight < self.concurrency:
+            priority, _, future = self._waiters[0]
+            if future.done():  # Cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+
+            self._refill()
+            now = time.monotonic()
+            delay = max(self.paused_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+                return
+
+            heapq.heappop(self._waiters)
+            self.tokens -= 1
+            self.in_flight += 1
+            future.set_result(None)
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._timer is None:
+            self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # Got the slot just as we were cancelled
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        if self._timer is None:
+            self._wake()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.throttled += 1
+        logging.warning("%s rate limited upstream, pausing for %.1fs", self.name, seconds)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=PRIORITY_NORMAL):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {"name": self.name, "in_flight": self.in_flight, "queued": self.queued,
+                "tokens": round(self.tokens, 2), "throttled": self.throttled}
+
+
+def parse_retry_after(value, default=1.0):
+    """Parse a Retry-After header given either in seconds or as an HTTP date."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+# One budget per kind of upstream call, see RATE_LIMITS in config.py
+limiters = {name: UpstreamLimiter(name, *budget) for name, budget in RATE_LIMITS.items()}
+
+
+def _limiter_samples(field):
+    return lambda: [({"budget": name}, limiter.stats()[field]) for name, limiter in limiters.items()]
+
+
+Gauge("upstream_in_flight", "Upstream requests in flight per budget", collect=_limiter_samples("in_flight"))
+Gauge("upstream_queued", "Upstream requests waiting for their budget", collect=_limiter_samples("queued"))
+Counter("upstream_throttled_total", "Times a budget was paused by a 429 answer", collect=_limiter_samples("throttled"))
+
+
+@contextlib.asynccontextmanager
+async def limited_request(budget, method, url, priority=PRIORITY_NORMAL, **kwargs):
+    """
+    Send a request through the shared session within the `budget` limiter.
+
+    Answers with status 429 pause the budget for their Retry-After and are retried
+    up to RATE_LIMIT_MAX_RETRIES times before raising `RateLimitedError`.
+    """
+    limiter = limiters[budget]
+    session = get_session()
+    try:
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            async with limiter.slot(priority):
+                start = time.monotonic()
+                async with session.request(method, url, **kwargs) as response:
+                    upstream_seconds.observe(time.monotonic() - start, budget=budget)
+                    upstream_requests.inc(budget=budget, status=response.status)
+                    if response.status != 429:
+                        yield response
+                        return
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    limiter.pause(retry_after)
+                    upstream_retries.inc(budget=budget)
+        raise RateLimitedError(f"Upstream rate limit reached, please try again in {retry_after:.0f}s")
+    except asyncio.TimeoutError:
+        upstream_errors.inc(budget=budget, kind="timeout")
+        raise
+    except RateLimitedError:
+        upstream_errors.inc(budget=budget, kind="rate_limited")
+        raise
+    except Exception:
+        upstream_errors.inc(budget=budget, kind="error")
+        raise
@@ -0,0 +1,73 @@
+import asyncio
+import functools
+import inspect
+import logging
+
+from logs import SAMPLED
+from metrics import Counter, Gauge
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls: while a call for `key` is in flight,
+    later callers await the same task instead of hitting the upstream again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.shared = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            self.shared += 1
+            logging.info("Joined in-flight call for %s", key[0], extra=SAMPLED)
+        # Shield so one caller giving up does not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+
+# Shared group for all upstream API calls
+api_calls = SingleFlight()
+
+Counter("singleflight_shared_total", "Calls that joined an identical in-flight call",
+        collect=lambda: [({}, api_calls.shared)])
+Gauge("singleflight_in_flight", "Distinct upstream calls in flight", collect=lambda: [({}, api_calls.in_flight)])
+
+
+def single_flight(func=None, *, key=None):
+    """
+    Decorator coalescing concurrent calls of an async function with identical arguments.
+
+    Parameters:
+    - key: Optional function building the coalescing key from the call arguments.
+    """
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        async def wrapper(*args, **kwargs):
+            if key is not None:
+                call_key = (f.__qualname__, key(*args, **kwargs))
+            else:
+                # Bind defaults so positional and keyword calls share a key
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                call_key = (f.__qualname__, tuple(bound.arguments.items()))
+            return await api_calls.do(call_key, f, *args, **kwargs)
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
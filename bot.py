@@ -1,17 +1,38 @@
 import discord
 from discord import app_commands
-from config import BOT_TOKEN, MAX_TABLE_SHOW
-from apis.api_sql import execute_query_and_fetch_results
-from utils import (split_message, get_table,
-                   format_dataframe_table,
-                   save_dataframe_as_image,
+from config import (BOT_TOKEN, MAX_TABLE_SHOW, DISCORD_UPLOAD_LIMIT, DISCORD_MAX_ATTACHMENTS, SQL_EXPORT_COST,
+                    BATCH_CONCURRENCY, BULK_MAX_ITEMS, BULK_PART_ITEMS, BULK_PROGRESS_INTERVAL, MAX_ROW_SHOW,
+                    AI_STREAM_EDIT_INTERVAL, DISCORD_MESSAGE_LIMIT, EXCEL_MAX_ROWS)
+from apis.api_sql import execute_preview_query, execute_query_and_stream_results
+from apis.http_client import start_session, close_session
+from scheduler import sql_scheduler, QueueFullError
+from jobs import job_manager
+from preflight import preflight, extract_sql, PreflightError
+from logs import setup_logging, stop_logging
+from tracing import start_trace, span, set_trace_attributes, exporter as span_exporter
+from metrics import (start_metrics_server, stop_metrics_server, command_seconds, phase_seconds, command_errors,
+                     upstream_seconds, latency_rows, value_rows)
+from render_pool import start_render_pool, shutdown_render_pool, render_table_png
+from utils import (split_message, get_preview,
+                   format_table,
+                   truncate_text,
+                   parse_batch_items,
+                   gather_limited,
+                   iter_limited,
+                   rows_to_csv_bytes,
                    get_network_id,
                    format_data_for_discord,
-                   generate_random_filename)
+                   generate_random_filename,
+                   split_file,
+                   EXPORT_WRITERS)
+import asyncio
+import gzip
 import json
+import logging
 import os
 import io
-import pandas as pd
+import tempfile
+import time
 from apis.api_web3 import (api_get_block_by_number,
                            api_get_transaction,
                            api_get_native_token_balance,
@@ -19,7 +40,7 @@ from apis.api_web3 import (api_get_block_by_number,
                            api_get_token_price,
                            api_get_nft_metadata,
                            api_resolve_ens_domain,
-                           api_flock_ai
+                           api_flock_ai_cached
                            )
 
 
@@ -29,105 +50,275 @@ class MyClient(discord.Client):
         self.tree = app_commands.CommandTree(self)
 
     async def setup_hook(self):
+        # Open the shared HTTP connection pool used by every API call
+        await start_session()
+        # Start the table-image rendering workers
+        start_render_pool()
+        # Re-attach to background SQL jobs that were running before a restart
+        job_manager.attach(self)
+        await job_manager.resume()
+        # Serve /metrics when METRICS_PORT is set
+        await start_metrics_server()
         try:
             await self.tree.sync()
         except Exception as e:
-            print(f"Error syncing commands: {e}")
+            logging.error("Error syncing commands: %s", e)
+
+    async def close(self):
+        job_manager.shutdown()
+        await stop_metrics_server()
+        await close_session()
+        shutdown_render_pool()
+        await super().close()
 
 
 intents = discord.Intents.default()
 client = MyClient(bot_intents=intents)
 
 
+@client.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    # Latency as seen by the user, from the interaction to the end of the handler
+    elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    command_seconds.observe(elapsed, command=command.name)
+
+
 @client.event
 async def on_ready():
-    print(f'Logged in as {client.user} (ID: {client.user.id})')
-    print('------')
+    logging.info("Logged in as %s (ID: %s)", client.user, client.user.id)
     await client.tree.sync()  # Ensure commands are synced globally
 
 
-@client.tree.command(name="sql")
-@app_commands.describe(query='Execute the SQL query to show up to 4 columns and 20 rows')
-async def sql(interaction: discord.Interaction, query: str):
-    """Executes an SQL query and returns the result."""
-    followup = None
-    total_columns = 0
-    total_rows = 0
-    try:
-        # Defer the interaction
+def progress_hook(followup):
+    """Build an `on_progress` callback that shows the live query status in the followup message."""
+    async def on_progress(status, elapsed):
+        await followup.edit(content=f"Please wait... status: `{status}` ({elapsed:.0f}s)")
+    return on_progress
+
+
+async def defer(interaction):
+    """Acknowledge the interaction, recording how long it took."""
+    with phase_seconds.time(phase="defer"), span("discord.defer"):
         await interaction.response.defer()
-        # Send a follow-up message
-        followup = await interaction.followup.send("Please wait...")
 
-        # Process the query
-        # Remove the semicolon if it exists at the end of the query
-        if query.strip().endswith(";"):
-            query = query.strip()[:-1]
-        response = await execute_query_and_fetch_results(query)
-        if response:
-            response_json = json.dumps(response)
-            if 'Data' in response_json:
-                # Access columns and data
-                columns = response['Columns']
-                column_names = [item['name'] for item in columns]
-                data = response['Data']
-                (df, total_columns, total_rows) = get_table(column_names, data)
-                table_image = save_dataframe_as_image(df)
-                result_str = table_image  # Set result_str to the image file path
-            else:
-                result_str = response  # String result
-        else:
-            result_str = "Failed to retrieve API data."
 
-        # Check if result_str is a file path or a string
-        if type(result_str) is str and os.path.isfile(result_str):
+def format_warnings(warnings):
+    """Format pre-flight warnings for the end of a result message."""
+    return "".join(f"\n  ⚠️ {warning}" for warning in warnings)
 
-            await followup.edit(content=(
-                f"  🔍 ** Query Executed: ** `{query}` \n\n"
-                f"  📊 ** Results: ** We found `{total_columns}` columns and `{total_rows}` "
-                f"rows. [Preview below ⬇️]"
-            ))
 
-            # Read the file as bytes
-            with open(result_str, 'rb') as file:
-                file_bytes = file.read()
+class StreamingReply:
+    """
+    Show text that grows over time, such as a streamed AI answer, in the followup message.
 
-            # Send the image file as bytes
-            discord_file = discord.File(fp=io.BytesIO(file_bytes), filename=os.path.basename(result_str))
-            await interaction.followup.send(content="🖼️  **Preview**:", file=discord_file)
+    Messages are edited at most every `interval` seconds to stay within Discord's edit
+    rate limits, and the text rolls over into new messages at the `split_message` boundary.
+    """
 
-            # Remove the temporary file after sending
-            os.remove(result_str)
-        else:
-            # Use the split_message utility function
-            result_str = str(result_str)
-            chunks = split_message(result_str)
+    def __init__(self, interaction, followup, header, prefix="", interval=AI_STREAM_EDIT_INTERVAL):
+        self.interaction = interaction
+        self.header = header
+        self.prefix = prefix
+        self.interval = interval
+        self.text = ""
+        self.messages = [followup]
+        self.contents = [None]  # What each message currently shows
+        self.last_edit = 0.0
 
-            await followup.edit(content=f'🔍 ** Query Executed: ** `{query} \n`')
+    async def append(self, text):
+        """Add streamed text, showing it if the last edit is old enough."""
+        self.text += text
+        if time.monotonic() - self.last_edit >= self.interval:
+            await self.show(f"{self.prefix}{self.text} ▌")
 
-            # Send remaining chunks as follow-up messages
-            chunk_count = 0
-            for chunk in chunks:
-                chunk_count += 1
-                await interaction.followup.send(f'```{chunk}```')
-                if chunk_count >= MAX_TABLE_SHOW:
-                    break  # Check if result_str is a file path or a string
+    async def show(self, result_str):
+        """Show `result_str`, editing only the messages whose content changed."""
+        self.last_edit = time.monotonic()
+        chunks = split_message(result_str)
+        for i, chunk in enumerate(chunks):
+            content = f'{self.header}{chunk}' if i == 0 else f'```{chunk}```'
+            if i == len(self.messages):
+                self.messages.append(await self.interaction.followup.send(content))
+                self.contents.append(content)
+            elif self.contents[i] != content:
+                await self.messages[i].edit(content=content)
+                self.contents[i] = content
+        # Drop messages left over from a longer in-progress text
+        for message in self.messages[len(chunks):]:
+            await message.delete()
+        del self.messages[len(chunks):], self.contents[len(chunks):]
+
+
+def queue_position_hook(followup):
+    """Build an `on_position` callback that shows the position in the SQL queue in the followup message."""
+    async def on_position(position):
+        await followup.edit(content=f"Please wait... you are `#{position}` in the queue")
+    return on_position
 
-    except Exception as e:
-        if followup:
-            await followup.edit(content=f'An error occurred: {e}')
-        else:
-            await interaction.followup.send(content=f'An error occurred: {e}', ephemeral=True)
 
+@client.tree.command(name="sql")
+@app_commands.describe(query='Execute the SQL query to show up to 4 columns and 20 rows',
+                       render='Show the preview as text or as an image (auto picks text when it fits)',
+                       background='Run as a background job and post the result here when it finishes')
+@app_commands.choices(render=[
+    app_commands.Choice(name="auto", value="auto"),
+    app_commands.Choice(name="text", value="text"),
+    app_commands.Choice(name="image", value="image"),
+])
+async def sql(interaction: discord.Interaction, query: str, render: str = "auto", background: bool = False):
+    """Executes an SQL query and returns the result."""
+    # Trace a sample of /sql commands end to end
+    with start_trace("sql", interaction_id=interaction.id, user_id=interaction.user.id,
+                     guild_id=interaction.guild_id, background=background):
+        followup = None
+        total_columns = 0
+        total_rows = 0
+        try:
+            # Defer the interaction
+            await defer(interaction)
+            # Send a follow-up message
+            with span("discord.followup"):
+                followup = await interaction.followup.send("Please wait...")
+
+            # Process the query
+            # Remove the semicolon if it exists at the end of the query
+            if query.strip().endswith(";"):
+                query = query.strip()[:-1]
+
+            # Check the query locally before paying for an upstream round trip
+            query, warnings = preflight(query, preview=not background)
+
+            if background:
+                job = await job_manager.submit(query, interaction.user.id, interaction.channel_id)
+                await followup.edit(content=(
+                    f"  🔍 ** Query Submitted: ** `{query}` \n\n"
+                    f"  🕒 Job `{job['id']}` is running, the result will be posted here when it finishes. "
+                    f"Use `/job_status {job['id']}` to check on it."
+                    f"{format_warnings(warnings)}"
+                ))
+                return
+            async with sql_scheduler.slot(interaction.user.id, interaction.guild_id,
+                                          on_position=queue_position_hook(followup)):
+                # Only the previewed rows and columns are fetched, plus a row count
+                response = await execute_preview_query(query, on_progress=progress_hook(followup))
+            text_table = None
+            if response:
+                if 'Data' in response:
+                    # Access columns and data
+                    columns = response['Columns']
+                    column_names = [item['name'] for item in columns]
+                    data = response['Data']
+                    # format_table fits cells to the message width itself
+                    with span("preview", rows=len(data)):
+                        (column_names, rows, _, fetched_rows) = get_preview(column_names, data, hidden=False)
+                    total_columns = response['TotalColumns']
+                    total_rows = response['TotalRows']
+                    if total_rows is None:
+                        total_rows = f"{fetched_rows}+" if fetched_rows >= MAX_ROW_SHOW else fetched_rows
+
+                    with phase_seconds.time(phase="render"), span("render") as rendering:
+                        if render != "image":
+                            text_table = format_table(column_names, rows)
+                            # Text mode drops rows until the table fits in one message
+                            while text_table is None and render == "text" and rows:
+                                rows = rows[:-1]
+                                text_table = format_table(column_names, rows)
+
+                        if rendering is not None:
+                            rendering.set(mode="text" if text_table is not None else "image")
+                        if text_table is not None:
+                            result_str = text_table
+                        else:
+                            # Render in the worker pool so the event loop stays responsive
+                            rows = [[truncate_text(value) for value in row] for row in rows]
+                            result_str = await render_table_png(column_names, rows)  # PNG bytes
+                else:
+                    result_str = response  # String result
+            else:
+                result_str = "Failed to retrieve API data."
 
-@client.tree.command(name="sql_excel")
-@app_commands.describe(query='Execute the SQL query and get the result in an Excel file.')
-async def sql_excel(interaction: discord.Interaction, query: str):
-    """Executes an SQL query and sends the result as an Excel file."""
+            # Check if result_str is a table preview or a string
+            if text_table is not None or isinstance(result_str, bytes):
+
+                await followup.edit(content=(
+                    f"  🔍 ** Query Executed: ** `{query}` \n\n"
+                    f"  📊 ** Results: ** We found `{total_columns}` columns and `{total_rows}` "
+                    f"rows. [Preview below ⬇️]"
+                    f"{format_warnings(warnings)}"
+                ))
+
+                if text_table is not None:
+                    with span("discord.followup"):
+                        await interaction.followup.send(content=f"🧾  **Preview**:\n```\n{text_table}\n```")
+                else:
+                    # Send the image bytes (BytesIO shares the bytes object instead of copying it)
+                    discord_file = discord.File(fp=io.BytesIO(result_str),
+                                                filename=generate_random_filename(extension='png'))
+                    with phase_seconds.time(phase="upload"), span("discord.upload", bytes=len(result_str)):
+                        await interaction.followup.send(content="🖼️  **Preview**:", file=discord_file)
+            else:
+                # Use the split_message utility function
+                result_str = str(result_str)
+                chunks = split_message(result_str)
+
+                await followup.edit(content=f'🔍 ** Query Executed: ** `{query} \n`')
+
+                # Send remaining chunks as follow-up messages
+                chunk_count = 0
+                for chunk in chunks:
+                    chunk_count += 1
+                    await interaction.followup.send(f'```{chunk}```')
+                    if chunk_count >= MAX_TABLE_SHOW:
+                        break  # Check if result_str is a file path or a string
+
+        except QueueFullError as e:
+            await followup.edit(content=f'⏳ {e}')
+        except PreflightError as e:
+            await followup.edit(content=f'🚫 {e}')
+        except Exception as e:
+            command_errors.inc(command=interaction.command.name)
+            set_trace_attributes(error=str(e))
+            if followup:
+                await followup.edit(content=f'An error occurred: {e}')
+            else:
+                await interaction.followup.send(content=f'An error occurred: {e}', ephemeral=True)
+
+
+@client.tree.command(name="job_status")
+@app_commands.describe(job_id='Background job ID returned by /sql')
+async def job_status(interaction: discord.Interaction, job_id: str):
+    """Shows the status of a background SQL job."""
+    job = await job_manager.get(job_id)
+    if job is None:
+        await interaction.response.send_message(f"No job found with ID `{job_id}`.", ephemeral=True)
+        return
+
+    elapsed = (job['finished_at'] or time.time()) - job['created_at']
+    content = (f"🕒 **Job** `{job['id']}`: `{job['status']}` after `{elapsed:.0f}s`\n"
+               f"🔍 **Query:** `{job['query']}`")
+    if job['error']:
+        content += f"\n⚠️ **Error:** {job['error']}"
+    await interaction.response.send_message(content, ephemeral=True)
+
+
+@client.tree.command(name="job_cancel")
+@app_commands.describe(job_id='Background job ID returned by /sql')
+async def job_cancel(interaction: discord.Interaction, job_id: str):
+    """Cancels one of your running background SQL jobs."""
+    if await job_manager.cancel(job_id, interaction.user.id):
+        await interaction.response.send_message(f"Job `{job_id}` cancelled.", ephemeral=True)
+    else:
+        await interaction.response.send_message(f"No running job of yours found with ID `{job_id}`.",
+                                                ephemeral=True)
+
+
+async def send_sql_export(interaction: discord.Interaction, query: str, export_format: str):
+    """Executes an SQL query and sends the result as a file in `export_format` (see `EXPORT_WRITERS`)."""
     followup = None
+    export_paths = []
     try:
         # Defer the interaction
-        await interaction.response.defer()
+        await defer(interaction)
         # Send a follow-up message
         followup = await interaction.followup.send("Please wait...")
 
@@ -135,44 +326,66 @@ async def sql_excel(interaction: discord.Interaction, query: str):
         # Remove the semicolon if it exists at the end of the query
         if query.strip().endswith(";"):
             query = query.strip()[:-1]
-        response = await execute_query_and_fetch_results(query)
-        if response:
-            response_json = json.dumps(response)
-            if 'Data' in response_json:
-                # Access columns and data
-                columns = response['Columns']
-                column_names = [item['name'] for item in columns]
-                data = response['Data']
 
-                # Prepare DataFrame for Excel file
-                (df, total_columns, total_rows) = get_table(column_names, data, max_column=None,
-                                                            max_row=None, hidden=False)
+        # Check the query locally before paying for an upstream round trip
+        query, warnings = preflight(query)
+
+        # Spool the raw results to a temporary file instead of memory
+        with tempfile.TemporaryFile() as results_file:
+            async with sql_scheduler.slot(interaction.user.id, interaction.guild_id, cost=SQL_EXPORT_COST,
+                                          on_position=queue_position_hook(followup)):
+                column_names, rows = await execute_query_and_stream_results(
+                    query, results_file, on_progress=progress_hook(followup))
+
+            if column_names is not None:
+                # Write the export file row by row, off the event loop
+                with tempfile.NamedTemporaryFile(suffix=f'.{export_format}', delete=False) as export_file:
+                    export_paths.append(export_file.name)
+                total_rows = await asyncio.to_thread(EXPORT_WRITERS[export_format], column_names, rows,
+                                                     export_paths[0])
+                total_columns = len(column_names)
+
+                # Split the file if it is over the upload limit
+                upload_limit = interaction.guild.filesize_limit if interaction.guild else DISCORD_UPLOAD_LIMIT
+                part_paths = await asyncio.to_thread(split_file, export_paths[0], upload_limit)
+                export_paths.extend(path for path in part_paths if path != export_paths[0])
+
+                # Excel sheets hold at most EXCEL_MAX_ROWS rows, the rest is dropped
+                if export_format == 'xlsx' and total_rows > EXCEL_MAX_ROWS:
+                    warnings.append(f"Only the first {EXCEL_MAX_ROWS} rows fit in an Excel sheet, the other "
+                                    f"{total_rows - EXCEL_MAX_ROWS} were dropped. Use `/sql_export` to get "
+                                    f"every row.")
 
                 # Send column and row information
                 await followup.edit(content=(
                     f"  🔍 ** Query Executed: ** `{query}` \n\n"
                     f"  📊  We found `{total_columns}` columns and `{total_rows}` rows. "
                     f"(download below :arrow_down: )\n\n"
+                    f"{format_warnings(warnings)}"
                 ))
 
                 # Generate a random filename
-                filename = generate_random_filename()
-
-                # Convert DataFrame to Excel
-                excel_buffer = io.BytesIO()
-                with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
-                    df.to_excel(writer, sheet_name='Sheet1', index=False)
-                excel_buffer.seek(0)
-
-                # Create a Discord file
-                discord_file = discord.File(fp=excel_buffer, filename=filename)
-                await interaction.followup.send(content=":inbox_tray:  **Download**:", file=discord_file)
-
-                # Cleanup: Close buffer
-                excel_buffer.close()
+                filename = generate_random_filename(extension=export_format)
+
+                if len(part_paths) == 1:
+                    # Create a Discord file
+                    discord_file = discord.File(fp=part_paths[0], filename=filename)
+                    with phase_seconds.time(phase="upload"):
+                        await interaction.followup.send(content=":inbox_tray:  **Download**:", file=discord_file)
+                else:
+                    # Send the parts in batches of attachments
+                    for i in range(0, len(part_paths), DISCORD_MAX_ATTACHMENTS):
+                        discord_files = [discord.File(fp=path, filename=f"{filename}.part{number}")
+                                         for number, path in enumerate(part_paths[i:i + DISCORD_MAX_ATTACHMENTS],
+                                                                       start=i + 1)]
+                        with phase_seconds.time(phase="upload"):
+                            await interaction.followup.send(
+                                content=(f":inbox_tray:  **Download** (parts {i + 1}-{i + len(discord_files)} of "
+                                         f"{len(part_paths)}, join them with `cat {filename}.part* > {filename}`):"),
+                                files=discord_files)
 
             else:
-                result_str = str(response)
+                result_str = str({'Error': rows})
                 chunks = split_message(result_str)
 
                 await followup.edit(content=f'🔍 ** Query Executed: ** `{query} \n`')
@@ -184,14 +397,68 @@ async def sql_excel(interaction: discord.Interaction, query: str):
                     await interaction.followup.send(f'```{chunk}```')
                     if chunk_count >= MAX_TABLE_SHOW:
                         break  # Check if result_str is a file path or a string
-        else:
-            await followup.edit(content="Failed to retrieve API data.")
 
+    except QueueFullError as e:
+        await followup.edit(content=f'⏳ {e}')
+    except PreflightError as e:
+        await followup.edit(content=f'🚫 {e}')
     except Exception as e:
+        command_errors.inc(command=interaction.command.name)
         if followup:
             await followup.edit(content=f'An error occurred: {e}')
         else:
             await interaction.followup.send(content=f'An error occurred: {e}', ephemeral=True)
+    finally:
+        # Cleanup: Remove the temporary export files
+        for path in export_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+@client.tree.command(name="sql_excel")
+@app_commands.describe(query='Execute the SQL query and get the result in an Excel file.')
+async def sql_excel(interaction: discord.Interaction, query: str):
+    """Executes an SQL query and sends the result as an Excel file."""
+    await send_sql_export(interaction, query, 'xlsx')
+
+
+@client.tree.command(name="sql_export")
+@app_commands.describe(query='Execute the SQL query and get the result as a file.',
+                       file_format='File format (compressed CSV, Parquet, Arrow IPC or Excel)')
+@app_commands.choices(file_format=[
+    app_commands.Choice(name="CSV (gzip)", value="csv.gz"),
+    app_commands.Choice(name="Parquet", value="parquet"),
+    app_commands.Choice(name="Arrow IPC", value="arrow"),
+    app_commands.Choice(name="Excel", value="xlsx"),
+])
+async def sql_export(interaction: discord.Interaction, query: str, file_format: str = "csv.gz"):
+    """Executes an SQL query and sends the result in a compact file format."""
+    await send_sql_export(interaction, query, file_format)
+
+
+async def send_batch_table(interaction: discord.Interaction, followup, columns, rows):
+    """Show batch results as a text table, or as a CSV attachment when they do not fit in a message."""
+    table = format_table(columns, rows)
+    if table is not None:
+        await followup.edit(content=f':bar_chart:  **Table Preview**: ```\n{table}\n```')
+    else:
+        discord_file = discord.File(fp=io.BytesIO(rows_to_csv_bytes(columns, rows)),
+                                    filename=generate_random_filename(extension='csv'))
+        await followup.edit(content=f':bar_chart:  **Results** for `{len(rows)}` items (download below :arrow_down: )')
+        with phase_seconds.time(phase="upload"):
+            await interaction.followup.send(content=":inbox_tray:  **Download**:", file=discord_file)
+
+
+def batch_value(response, key=None):
+    """Pick the value to show for one batch item, or the error message."""
+    if response and 'data' in response and response['data'] is not None and response['data'] != "null":
+        data = response['data']
+        if key is not None and isinstance(data, dict):
+            return data.get(key)
+        return data
+    if response and 'Error' in response:
+        return f"Error: {response['Error']}"
+    return f"Error: {response.get('message', 'no data') if response else 'no data'}"
 
 
 @client.tree.command(name="get_block_by_number")
@@ -201,7 +468,7 @@ async def get_block_by_number(interaction: discord.Interaction, number: str, cha
     followup = None
     try:
         # Defer the interaction
-        await interaction.response.defer()
+        await defer(interaction)
         # Send a follow-up message
         followup = await interaction.followup.send("Please wait...")
 
@@ -241,6 +508,7 @@ async def get_block_by_number(interaction: discord.Interaction, number: str, cha
                 break
 
     except Exception as e:
+        command_errors.inc(command=interaction.command.name)
         if followup:
             await followup.edit(content=f'An error occurred: {e}')
         else:
@@ -255,7 +523,7 @@ async def get_transaction(interaction: discord.Interaction, tx_hash: str, chain:
     """Get the detail of a transaction given the transaction hash"""
     followup = None
     try:
-        await interaction.response.defer()
+        await defer(interaction)
         followup = await interaction.followup.send("Please wait...")
 
         response = await api_get_transaction(tx_hash, get_network_id(chain), block_number, tx_index)
@@ -282,6 +550,116 @@ async def get_transaction(interaction: discord.Interaction, tx_hash: str, chain:
             await interaction.followup.send(f':bar_chart:  **Preview**: ```{chunk}```')
 
     except Exception as e:
+        command_errors.inc(command=interaction.command.name)
+        if followup:
+            await followup.edit(content=f'An error occurred: {e}')
+        else:
+            await interaction.followup.send(content=f'An error occurred: {e}', ephemeral=True)
+
+
+async def send_bulk_fetch(interaction: discord.Interaction, followup, label, func, args_list, names):
+    """
+    Fetch many items in order, reporting progress as results arrive, and send them
+    as gzip-compressed JSON-lines attachments of BULK_PART_ITEMS items each.
+
+    Each part is sent as soon as it is complete, and the items fetched so far are
+    still sent when the command fails partway through.
+    """
+    fetched = 0
+    errors = 0
+    sent = 0
+    last_update = time.monotonic()
+    buffer = io.BytesIO()
+    archive = gzip.GzipFile(fileobj=buffer, mode='wb')
+
+    async def send_part():
+        nonlocal buffer, archive, sent
+        archive.close()
+        buffer.seek(0)
+        filename = f"Chainbase_{label}_{sent + 1}-{fetched}.jsonl.gz"
+        with phase_seconds.time(phase="upload"):
+            await interaction.followup.send(content=f":inbox_tray:  **Download** ({label} {sent + 1}-{fetched}):",
+                                            file=discord.File(fp=buffer, filename=filename))
+        sent = fetched
+        buffer = io.BytesIO()
+        archive = gzip.GzipFile(fileobj=buffer, mode='wb')
+
+    try:
+        async for response in iter_limited(func, args_list, limit=BATCH_CONCURRENCY):
+            fetched += 1
+            if response and response.get('data') not in (None, "null"):
+                record = response['data']
+            else:
+                errors += 1
+                record = {'error': response.get('Error') or response.get('message') if response else 'no data'}
+            archive.write((json.dumps({'item': names[fetched - 1], 'data': record}) + "\n").encode('utf-8'))
+
+            if fetched - sent >= BULK_PART_ITEMS and fetched < len(args_list):
+                await send_part()
+            if time.monotonic() - last_update >= BULK_PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                await followup.edit(content=f"Please wait... fetched `{fetched}/{len(args_list)}` {label}")
+    except Exception:
+        # Deliver what was fetched before the failure
+        if fetched > sent:
+            try:
+                await send_part()
+            except Exception as e:
+                logging.error("Failed to send the partial %s: %s", label, e)
+        raise
+
+    await followup.edit(content=(f":bar_chart:  Fetched `{fetched - errors}` {label}"
+                                 + (f", `{errors}` failed" if errors else "")
+                                 + ". (download below :arrow_down: )"))
+    await send_part()
+
+
+@client.tree.command(name="get_blocks")
+@app_commands.describe(start='First block number', end='Last block number', chain='Chain ID or Name')
+async def get_blocks(interaction: discord.Interaction, start: int, end: int, chain: str):
+    """Fetches the details of a range of blocks."""
+    followup = None
+    try:
+        await defer(interaction)
+        followup = await interaction.followup.send("Please wait...")
+
+        chain_id = get_network_id(chain)
+        if chain_id is None:
+            raise ValueError(f"Unknown chain `{chain}`")
+        if start < 0 or end < start:
+            raise ValueError("`end` must be greater than or equal to `start`")
+        if end - start + 1 > BULK_MAX_ITEMS:
+            raise ValueError(f"Too many blocks, the limit is {BULK_MAX_ITEMS}")
+
+        numbers = list(range(start, end + 1))
+        await send_bulk_fetch(interaction, followup, "blocks", api_get_block_by_number,
+                              [(str(number), chain_id) for number in numbers], numbers)
+
+    except Exception as e:
+        command_errors.inc(command=interaction.command.name)
+        if followup:
+            await followup.edit(content=f'An error occurred: {e}')
+        else:
+            await interaction.followup.send(content=f'An error occurred: {e}', ephemeral=True)
+
+
+@client.tree.command(name="get_transactions")
+@app_commands.describe(tx_hashes='Transaction hashes separated by commas or spaces, optionally as chain:hash',
+                       chain='Default chain ID or Name')
+async def get_transactions(interaction: discord.Interaction, tx_hashes: str, chain: str):
+    """Get the details of a list of transactions"""
+    followup = None
+    try:
+        await defer(interaction)
+        followup = await interaction.followup.send("Please wait...")
+
+        items = parse_batch_items(tx_hashes, chain, max_items=BULK_MAX_ITEMS)
+        await send_bulk_fetch(interaction, followup, "transactions", api_get_transaction,
+                              [(tx_hash, chain_id) for _, chain_id, tx_hash in items],
+                              [tx_hash for _, _, tx_hash in items])
+
+    except Exception as e:
+        command_errors.inc(command=interaction.command.name)
         if followup:
             await followup.edit(content=f'An error occurred: {e}')
         else:
@@ -294,7 +672,7 @@ async def get_native_token_balance(interaction: discord.Interaction, address: st
     """Get the native token balance for a specified address"""
     followup = None
     try:
-        await interaction.response.defer()
+        await defer(interaction)
         followup = await interaction.followup.send("Please wait...")
 
         response = await api_get_native_token_balance(address, get_network_id(chain), block)
@@ -319,6 +697,34 @@ async def get_native_token_balance(interaction: discord.Interaction, address: st
             await interaction.followup.send(f':bar_chart:  **Preview**: ```{chunk}```')
 
     except Exception as e:
+        command_errors.inc(command=interaction.command.name)
+        if followup:
+            await followup.edit(content=f'An error occurred: {e}')
+        else:
+            await interaction.followup.send(content=f'An error occurred: {e}', ephemeral=True)
+
+
+@client.tree.command(name="get_native_token_balances")
+@app_commands.describe(addresses='Addresses separated by commas or spaces, optionally as chain:address',
+                       chain='Default chain ID or Name', block='Block number or "latest"')
+async def get_native_token_balances(interaction: discord.Interaction, addresses: str, chain: str,
+                                    block: str = "latest"):
+    """Get the native token balances for a list of addresses"""
+    followup = None
+    try:
+        await defer(interaction)
+        followup = await interaction.followup.send("Please wait...")
+
+        items = parse_batch_items(addresses, chain)
+        responses = await gather_limited(api_get_native_token_balance,
+                                         [(address, chain_id, block) for _, chain_id, address in items])
+
+        rows = [[chain_name, address, batch_value(response)]
+                for (chain_name, _, address), response in zip(items, responses)]
+        await send_batch_table(interaction, followup, ["chain", "address", "balance"], rows)
+
+    except Exception as e:
+        command_errors.inc(command=interaction.command.name)
         if followup:
             await followup.edit(content=f'An error occurred: {e}')
         else:
@@ -331,7 +737,7 @@ async def get_token_metadata(interaction: discord.Interaction, contract_address:
     """Get the metadata of a specified token"""
     followup = None
     try:
-        await interaction.response.defer()
+        await defer(interaction)
         followup = await interaction.followup.send("Please wait...")
 
         response = await api_get_token_metadata(contract_address, get_network_id(chain))
@@ -358,6 +764,7 @@ async def get_token_metadata(interaction: discord.Interaction, contract_address:
             await interaction.followup.send(f':bar_chart:  **Preview**: ```{chunk}```')
 
     except Exception as e:
+        command_errors.inc(command=interaction.command.name)
         if followup:
             await followup.edit(content=f'An error occurred: {e}')
         else:
@@ -370,7 +777,7 @@ async def get_token_price(interaction: discord.Interaction, contract_address: st
     """Get the price of a specified token"""
     followup = None
     try:
-        await interaction.response.defer()
+        await defer(interaction)
         followup = await interaction.followup.send("Please wait...")
 
         response = await api_get_token_price(contract_address, get_network_id(chain))
@@ -397,6 +804,34 @@ async def get_token_price(interaction: discord.Interaction, contract_address: st
             await interaction.followup.send(f':bar_chart:  **Preview**: ```{chunk}```')
 
     except Exception as e:
+        command_errors.inc(command=interaction.command.name)
+        if followup:
+            await followup.edit(content=f'An error occurred: {e}')
+        else:
+            await interaction.followup.send(content=f'An error occurred: {e}', ephemeral=True)
+
+
+@client.tree.command(name="get_token_prices")
+@app_commands.describe(contract_addresses='Token contract addresses separated by commas or spaces, '
+                                          'optionally as chain:address',
+                       chain='Default chain ID or Name')
+async def get_token_prices(interaction: discord.Interaction, contract_addresses: str, chain: str):
+    """Get the prices of a list of tokens"""
+    followup = None
+    try:
+        await defer(interaction)
+        followup = await interaction.followup.send("Please wait...")
+
+        items = parse_batch_items(contract_addresses, chain)
+        responses = await gather_limited(api_get_token_price,
+                                         [(address, chain_id) for _, chain_id, address in items])
+
+        rows = [[chain_name, address, batch_value(response, 'price'), batch_value(response, 'updated_at')]
+                for (chain_name, _, address), response in zip(items, responses)]
+        await send_batch_table(interaction, followup, ["chain", "contract", "price", "updated_at"], rows)
+
+    except Exception as e:
+        command_errors.inc(command=interaction.command.name)
         if followup:
             await followup.edit(content=f'An error occurred: {e}')
         else:
@@ -409,7 +844,7 @@ async def get_nft_metadata(interaction: discord.Interaction, contract_address: s
     """Get the metadata associated with the specified NFT"""
     followup = None
     try:
-        await interaction.response.defer()
+        await defer(interaction)
         followup = await interaction.followup.send("Please wait...")
 
         response = await api_get_nft_metadata(contract_address, nft_id, get_network_id(chain))
@@ -436,6 +871,7 @@ async def get_nft_metadata(interaction: discord.Interaction, contract_address: s
             await interaction.followup.send(f':bar_chart:  **Preview**: ```{chunk}```')
 
     except Exception as e:
+        command_errors.inc(command=interaction.command.name)
         if followup:
             await followup.edit(content=f'An error occurred: {e}')
         else:
@@ -448,7 +884,7 @@ async def resolve_ens_domain(interaction: discord.Interaction, domain: str, chai
     """Resolve an ENS domain to its associated address"""
     followup = None
     try:
-        await interaction.response.defer()
+        await defer(interaction)
         followup = await interaction.followup.send("Please wait...")
 
         response = await api_resolve_ens_domain(domain, get_network_id(chain), block)
@@ -475,45 +911,154 @@ async def resolve_ens_domain(interaction: discord.Interaction, domain: str, chai
             await interaction.followup.send(f':bar_chart:  **Preview**: ```{chunk}```')
 
     except Exception as e:
+        command_errors.inc(command=interaction.command.name)
         if followup:
             await followup.edit(content=f'An error occurred: {e}')
         else:
             await interaction.followup.send(content=f'An error occurred: {e}', ephemeral=True)
 
+
+async def run_generated_sql(interaction: discord.Interaction, query: str):
+    """Check SQL written by the AI against the table catalog, run it and return a preview message."""
+    try:
+        query, warnings = preflight(query, preview=True)
+        async with sql_scheduler.slot(interaction.user.id, interaction.guild_id):
+            response = await execute_preview_query(query)
+    except PreflightError as e:
+        return f"🚫 The generated SQL was not run: {e}"[:DISCORD_MESSAGE_LIMIT]
+    except QueueFullError as e:
+        return f"⏳ {e}"
+
+    if not response or 'Data' not in response:
+        error = response.get('Error') if response else 'no response'
+        return f"🔍 ** Generated query failed: ** {error}"[:DISCORD_MESSAGE_LIMIT]
+
+    column_names = [item['name'] for item in response['Columns']]
+    (column_names, rows, _, fetched_rows) = get_preview(column_names, response['Data'], hidden=False)
+    total_rows = response['TotalRows']
+    if total_rows is None:
+        total_rows = f"{fetched_rows}+" if fetched_rows >= MAX_ROW_SHOW else fetched_rows
+    content = (f"  📊 ** Results of the generated query: ** We found `{response['TotalColumns']}` columns "
+               f"and `{total_rows}` rows.{format_warnings(warnings)}\n")
+
+    # Drop rows until the table fits in the same message
+    table = format_table(column_names, rows, limit=DISCORD_MESSAGE_LIMIT - len(content) - 8)
+    while table is None and rows:
+        rows = rows[:-1]
+        table = format_table(column_names, rows, limit=DISCORD_MESSAGE_LIMIT - len(content) - 8)
+    return f"{content}```\n{table}\n```" if table else content
+
+
 @client.tree.command(name="ask_ai")
-@app_commands.describe(query="Ask the AI a question and get the response.")
-async def ask_ai(interaction: discord.Interaction, query: str):
+@app_commands.describe(query="Ask the AI a question and get the response.",
+                       run_sql="Also run the SQL query from the answer and show a preview of its results.")
+async def ask_ai(interaction: discord.Interaction, query: str, run_sql: bool = False):
     """Send the user's query to the AI API and return the response."""
     followup = None
+    query_task = None
     try:
         # Defer the interaction
-        await interaction.response.defer()
+        await defer(interaction)
         # Send a follow-up message
         followup = await interaction.followup.send("Processing your request...")
 
-        # Call the AI API to get the answer to the user's query
-        response = await api_flock_ai(query)
+        # Call the AI API to get the answer to the user's query, unless a cached answer matches,
+        # showing the answer while it streams in
+        reply = StreamingReply(interaction, followup, header=f'🔍 **Question:** `{query}`\n\n',
+                               prefix="**AI's Response**: ")
+
+        async def on_chunk(text):
+            nonlocal query_task
+            await reply.append(text)
+            # Start the query as soon as its code block is complete, while the rest of the answer streams
+            if run_sql and query_task is None:
+                generated_sql = extract_sql(reply.text)
+                if generated_sql is not None:
+                    query_task = asyncio.create_task(run_generated_sql(interaction, generated_sql))
+
+        response, hit = await api_flock_ai_cached(query, on_chunk=on_chunk)
         if response:
             result_str = f"**AI's Response**: {response}"
+            if hit is not None and hit['match'] == "exact":
+                result_str = f"♻️ *Cached answer*\n{result_str}"
+            elif hit is not None:
+                result_str = (f"♻️ *Cached answer to a similar question* (`{hit['question']}`, "
+                              f"{hit['similarity']:.0%} similar)\n{result_str}")
 
         else:
             result_str = "Failed to retrieve a response from the AI."
 
-        # Send the result back to the user
-        result_str = str(result_str)
-        chunks = split_message(result_str)  # Split the message if too long
-
-        await followup.edit(content=f'🔍 **Question:** `{query}`\n\n{chunks[0]}')
-
-        for chunk in chunks[1:]:
-            await interaction.followup.send(f'```{chunk}```')
+        # Show the final result, split over several messages if too long
+        await reply.show(str(result_str))
+
+        if run_sql:
+            # Cached and non-streamed answers arrive whole
+            generated_sql = extract_sql(response) if query_task is None and isinstance(response, str) else None
+            if generated_sql is not None and hit is not None and hit['match'] == "similar":
+                # The SQL answers another question, which may differ in what matters (a token, a date)
+                await interaction.followup.send("🚫 The SQL of an answer to a similar question is not run "
+                                                "automatically, check it and run it with `/sql`.")
+            elif generated_sql is not None:
+                query_task = asyncio.create_task(run_generated_sql(interaction, generated_sql))
+            if query_task is not None:
+                # Failures are reported in their own message, leaving the answer above in place
+                try:
+                    result = await query_task
+                except Exception as e:
+                    command_errors.inc(command=interaction.command.name)
+                    result = f"🔍 ** Generated query failed: ** {e}"[:DISCORD_MESSAGE_LIMIT]
+                await interaction.followup.send(result)
+            elif generated_sql is None:
+                await interaction.followup.send("🚫 The answer does not contain an SQL query to run.")
 
     except Exception as e:
+        command_errors.inc(command=interaction.command.name)
         if followup:
             await followup.edit(content=f'An error occurred: {e}')
         else:
             await interaction.followup.send(content=f'An error occurred: {e}', ephemeral=True)
-
+    finally:
+        if query_task is not None and not query_task.done():
+            query_task.cancel()
+
+
+def table_messages(columns, rows):
+    """Split rows into as many text tables as needed to fit each in a message."""
+    tables = []
+    chunk = []
+    for row in rows:
+        if chunk and format_table(columns, chunk + [row]) is None:
+            tables.append(format_table(columns, chunk))
+            chunk = []
+        chunk.append(row)
+    if chunk:
+        tables.append(format_table(columns, chunk))
+    return tables
+
+
+@client.tree.command(name="stats")
+@app_commands.default_permissions(administrator=True)
+async def stats_command(interaction: discord.Interaction):
+    """Shows latency, error and queue metrics (administrators only)."""
+    if not interaction.permissions.administrator:
+        await interaction.response.send_message("Only server administrators can use this command.",
+                                                ephemeral=True)
+        return
+
+    messages = []
+    for title, histogram in [("command", command_seconds), ("phase", phase_seconds),
+                             ("upstream", upstream_seconds)]:
+        rows = latency_rows(histogram)
+        if rows:
+            messages.extend(table_messages([title, "count", "avg", "p50", "p95"], rows))
+    messages.extend(table_messages(["metric", "value"], value_rows()))
+
+    if not messages:
+        await interaction.response.send_message("No metrics recorded yet.", ephemeral=True)
+        return
+    await interaction.response.send_message(f"📈  **Stats**:\n```\n{messages[0]}\n```", ephemeral=True)
+    for table in messages[1:]:
+        await interaction.followup.send(f"```\n{table}\n```", ephemeral=True)
 
 
 @client.tree.command(name="help")
@@ -521,14 +1066,23 @@ async def help_command(interaction: discord.Interaction):
     """Provides information about available commands."""
     commands_info = [
         {"name": "/sql", "description": "Execute the SQL query to show up to 4 columns and 20 rows."},
+        {"name": "/ask_ai", "description": "Ask the AI for help with a query; with run_sql:True it also runs the SQL it writes."},
+        {"name": "/job_status", "description": "Show the status of a background SQL job (started with /sql background:True)."},
+        {"name": "/job_cancel", "description": "Cancel one of your running background SQL jobs."},
         {"name": "/sql_excel", "description": "Execute the SQL query and get the result in an Excel file."},
+        {"name": "/sql_export", "description": "Execute the SQL query and get the result as CSV (gzip), Parquet or Arrow."},
         {"name": "/get_block_by_number", "description": "Fetch block details by block number and chain ID."},
         {"name": "/get_transaction", "description": "Get the details of a transaction given the transaction hash."},
+        {"name": "/get_blocks", "description": "Fetch the details of a range of blocks as a compressed file."},
+        {"name": "/get_transactions", "description": "Fetch the details of a list of transactions as a compressed file."},
         {"name": "/get_native_token_balance", "description": "Get the native token balance for a specified address."},
+        {"name": "/get_native_token_balances", "description": "Get the native token balances for a list of addresses."},
         {"name": "/get_token_metadata", "description": "Get the metadata of a specified token."},
         {"name": "/get_token_price", "description": "Get the price of a specified token."},
+        {"name": "/get_token_prices", "description": "Get the prices of a list of tokens."},
         {"name": "/get_nft_metadata", "description": "Get the metadata associated with the specified NFT."},
         {"name": "/get_domain_metadata", "description": "Resolve an ENS domain to its associated address."},
+        {"name": "/stats", "description": "Show latency, error and queue metrics (administrators only)."},
     ]
 
     help_text = "**Available Commands:**\n\n"
@@ -539,4 +1093,10 @@ async def help_command(interaction: discord.Interaction):
 
 
 def run_bot():
-    client.run(BOT_TOKEN)
+    # Log through a background thread instead of discord.py's own handler
+    setup_logging()
+    try:
+        client.run(BOT_TOKEN, log_handler=None)
+    finally:
+        span_exporter.shutdown()
+        stop_logging()
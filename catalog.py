@@ -0,0 +1,170 @@
+import math
+import os
+import re
+from collections import Counter
+
+from config import AI_TOP_K_TABLES
+
+# The table catalog shipped with the AI system prompt
+CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "apis", "system_prompt_with_table_data.txt")
+
+# Lines that start and end the table list in the catalog file
+TABLES_HEADER = "Here is the list of tables and their parameters available to you for crafting SQL queries:"
+EXAMPLES_HEADER = "## SQL Examples:"
+
+
+def load_table_catalog(path=CATALOG_FILE):
+    """
+    Parse the "- `schema.table`: column, column, ..." lines of the catalog file.
+
+    Returns:
+    - dict: Table name -> list of column names, in file order.
+    """
+    catalog = {}
+    with open(path, "r") as f:
+        for line in f:
+            match = re.match(r"- `([\w.]+)`:\s*(.*)", line.strip())
+            if match:
+                catalog[match.group(1).lower()] = [column.strip() for column in match.group(2).split(",")
+                                                   if column.strip()]
+    return catalog
+
+
+def load_prompt_sections(path=CATALOG_FILE):
+    """
+    Split the catalog file into the guidelines before the table list and the SQL examples after it.
+
+    Returns:
+    - (guidelines, examples)
+    """
+    with open(path, "r") as f:
+        text = f.read()
+    guidelines = text.split(TABLES_HEADER)[0].strip()
+    examples = text.split(EXAMPLES_HEADER, 1)[1].strip() if EXAMPLES_HEADER in text else ""
+    return guidelines, examples
+
+
+def tokenize_words(text):
+    """Lowercase words of `text`, split on underscores and dots, with a plural 's' removed."""
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    return [word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+            for word in words]
+
+
+class BM25Index:
+    """Okapi BM25 ranking over tokenized documents, with an inverted index for lookups."""
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(tokens) for tokens in documents]
+        self.lengths = [len(tokens) for tokens in documents]
+        self.average_length = sum(self.lengths) / max(len(documents), 1)
+        self.postings = {}
+        for doc_id, counts in enumerate(self.term_counts):
+            for term in counts:
+                self.postings.setdefault(term, []).append(doc_id)
+        self.idf = {term: math.log(1 + (len(documents) - len(ids) + 0.5) / (len(ids) + 0.5))
+                    for term, ids in self.postings.items()}
+
+    def scores(self, tokens):
+        """Return the BM25 score of every document matching at least one token."""
+        scores = {}
+        for term in set(tokens):
+            for doc_id in self.postings.get(term, ()):
+                frequency = self.term_counts[doc_id][term]
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / self.average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + self.idf[term] * frequency * (self.k1 + 1) / (
+                    frequency + norm)
+        return scores
+
+
+table_catalog = load_table_catalog()
+catalog_schemas = {table.split(".")[0] for table in table_catalog}
+# Words of the table and column names, which say what a question is about without naming a token or project
+catalog_words = frozenset(word for table, columns in table_catalog.items()
+                          for word in re.findall(r"[a-z0-9]+", " ".join([table] + columns).lower()))
+prompt_guidelines, prompt_examples = load_prompt_sections()
+
+# Common short names of the chains, added to questions that use them
+CHAIN_ALIASES = {"eth": "ethereum", "bnb": "bsc", "matic": "polygon", "arb": "arbitrum", "op": "optimism"}
+
+# Chain whose tables are sent when the question does not name one
+DEFAULT_CHAIN = "ethereum"
+
+# Tables sent when nothing in the question matches the catalog
+DEFAULT_TABLES = ("transactions", "blocks", "token_transfers", "erc20_balances", "token_metas", "token_prices")
+
+# The same table exists on many chains, so tables are ranked by name (without the
+# schema) and only then expanded to the chains the question is about
+table_schemas = {}
+for _table in table_catalog:
+    _schema, _name = _table.split(".", 1)
+    table_schemas.setdefault(_name, []).append(_schema)
+
+
+def _columns(name):
+    return table_catalog[f"{table_schemas[name][0]}.{name}"]
+
+
+# Table names, columns and schemas are indexed separately, matches on the name weigh more
+NAME_WEIGHT = 2.0
+# Weight of tables on none of the chains a question names (tables with a `blockchain` column cover every chain)
+OTHER_CHAIN_WEIGHT = 0.3
+_names = list(table_schemas)
+name_index = BM25Index([tokenize_words(name) for name in _names])
+column_index = BM25Index([tokenize_words(" ".join(_columns(name))) for name in _names])
+schema_index = BM25Index([tokenize_words(" ".join(table_schemas[name])) for name in _names])
+
+
+def expand_table(name, chains):
+    """Return the `schema.name` tables for the chains asked about, or the one on the default (or only) chain."""
+    schemas = table_schemas[name]
+    asked = [chain for chain in chains if chain in schemas]
+    if asked:
+        return [f"{chain}.{name}" for chain in asked]
+    return [f"{DEFAULT_CHAIN if DEFAULT_CHAIN in schemas else schemas[0]}.{name}"]
+
+
+def relevant_tables(question, k=AI_TOP_K_TABLES):
+    """Return the names of the `k` tables that best match the question."""
+    tokens = tokenize_words(question)
+    tokens += [CHAIN_ALIASES[token] for token in tokens if token in CHAIN_ALIASES]
+    chains = list(dict.fromkeys(token for token in tokens if token in catalog_schemas))
+
+    scores = Counter()
+    for doc_id, score in name_index.scores(tokens).items():
+        scores[doc_id] += NAME_WEIGHT * score
+    for doc_id, score in column_index.scores(tokens).items():
+        scores[doc_id] += score
+    for doc_id, score in schema_index.scores(tokens).items():
+        scores[doc_id] += score
+    if chains:
+        for doc_id in scores:
+            name = _names[doc_id]
+            if not set(chains) & set(table_schemas[name]) and "blockchain" not in _columns(name):
+                scores[doc_id] *= OTHER_CHAIN_WEIGHT
+    names = [_names[doc_id] for doc_id, _ in scores.most_common()] or list(DEFAULT_TABLES)
+
+    tables = []
+    for name in names:
+        tables.extend(expand_table(name, chains))
+        if len(tables) >= k:
+            break
+    return tables[:k]
+
+
+def build_system_prompt(question, k=AI_TOP_K_TABLES):
+    """
+    Build a compact system prompt: the guidelines, the `k` tables most relevant
+    to the question, and the SQL examples.
+
+    The guidelines come first and never change, so endpoints that cache
+    prompt prefixes can reuse them across questions.
+    """
+    tables = relevant_tables(question, k)
+    table_lines = "\n".join(f"- `{name}`: {', '.join(table_catalog[name])}" for name in tables)
+    return (f"{prompt_guidelines}\n\n"
+            f"Here are the tables most relevant to the question and their parameters:\n\n"
+            f"{table_lines}\n\n"
+            f"{EXAMPLES_HEADER}\n{prompt_examples}")
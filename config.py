@@ -7,11 +7,123 @@ CHAINBASE_API_WEB3_URL = os.getenv('CHAINBASE_WEB3_BASE_URL')
 CHAINBASE_API_KEY = os.getenv('CHAINBASE_API_KEY')
 FLOCK_AUTH_TOKEN = os.getenv('FLOCK_AUTH_TOKEN')
 
-API_TIME_LIMIT = 20
 MAX_COLUMN_SHOW = 4
 MAX_TABLE_SHOW = 2
 MAX_ROW_SHOW = 20
+DISCORD_MESSAGE_LIMIT = 1900  # Discord allows 2000 characters, leave room for formatting
+TEXT_TABLE_MAX_WIDTH = 72
+TEXT_TABLE_MIN_COLUMN_WIDTH = 6
 API_TIMEOUT = 120
+AI_TOP_K_TABLES = int(os.getenv('AI_TOP_K_TABLES', 8))  # tables sent with each /ask_ai question, 0 for all
+AI_STREAM = os.getenv('AI_STREAM', 'true').lower() == 'true'  # ask the AI endpoint to stream its answer
+AI_STREAM_EDIT_INTERVAL = float(os.getenv('AI_STREAM_EDIT_INTERVAL', 1.5))  # seconds between message edits
+
+# Logging
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text or json
+LOG_MAX_CHARS = int(os.getenv('LOG_MAX_CHARS', 1000))  # per message and per field
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.1))  # fraction of high-volume records kept
+LOG_QUEUE_SIZE = 10000  # records waiting for the log thread before new ones are dropped
+
+# Metrics endpoint (off unless METRICS_PORT is set)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT')) if os.getenv('METRICS_PORT') else None
+
+# Tracing of /sql commands
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))  # fraction of commands traced
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')  # JSON-lines file the spans are appended to
+TRACE_COLLECTOR_URL = os.getenv('TRACE_COLLECTOR_URL')  # POST spans here instead of writing TRACE_FILE
+TRACE_QUEUE_SIZE = 10000  # spans waiting to be written before new ones are dropped
+
+# Tables too large to scan without a WHERE or LIMIT clause (by table name, on any chain)
+SCAN_GUARDED_TABLES = {
+    'transactions', 'transaction_logs', 'transaction_logs_decoded', 'trace_calls', 'trace_calls_decoded',
+    'traces', 'token_transfers', 'erc20_transfer', 'erc721_transfer', 'erc1155_transfer_single',
+    'erc1155_transfer_batch', 'erc20_balances_historical', 'nft_holders_historical',
+}
+# Rows counted at most for the /sql row total, shown as "N+" when reached
+SCAN_COUNT_CAP = int(os.getenv('SCAN_COUNT_CAP', 10000))
+
+# Upstream budgets: (requests per second, burst, max concurrent requests)
+RATE_LIMITS = {
+    'sql_execute': (1, 2, 4),
+    'sql_status': (5, 10, 10),
+    'sql_results': (2, 4, 4),  # Result downloads, kept apart so large exports never hold up submissions
+    'web3': (5, 10, 10),
+    'flock_ai': (1, 3, 2),
+}
+RATE_LIMIT_MAX_RETRIES = 3
+
+# SQL status polling (seconds)
+SQL_POLL_FIRST_DELAY = float(os.getenv('SQL_POLL_FIRST_DELAY', 0.3))
+SQL_POLL_BASE_DELAY = float(os.getenv('SQL_POLL_BASE_DELAY', 1))
+SQL_POLL_MAX_DELAY = float(os.getenv('SQL_POLL_MAX_DELAY', 10))
+SQL_POLL_DEADLINE = float(os.getenv('SQL_POLL_DEADLINE', 120))
+
+# Batch lookup commands
+BATCH_MAX_ITEMS = 50
+BATCH_CONCURRENCY = 5
+BULK_MAX_ITEMS = 1000  # Blocks or transactions per /get_blocks or /get_transactions
+BULK_PROGRESS_INTERVAL = 2  # Seconds between progress updates
+BULK_PART_ITEMS = 250  # Items per attachment, each sent as soon as it is complete
+
+# Fair-share scheduling of SQL commands across users and guilds
+SQL_MAX_IN_FLIGHT = int(os.getenv('SQL_MAX_IN_FLIGHT', 8))
+SQL_MAX_QUEUED = int(os.getenv('SQL_MAX_QUEUED', 50))
+SQL_MAX_PER_USER = int(os.getenv('SQL_MAX_PER_USER', 2))
+SQL_MAX_PER_GUILD = int(os.getenv('SQL_MAX_PER_GUILD', 10))
+SQL_GUILD_WEIGHTS = {}  # guild id -> share weight, 1 by default
+SQL_EXPORT_COST = 3  # Exports count as this many /sql runs in the fair queue
+
+# Background SQL jobs
+JOBS_DB = os.getenv('JOBS_DB', 'jobs.sqlite')
+JOB_MAX_PER_USER = 3
+JOB_POLL_MAX_DELAY = 30  # Seconds between status checks of a background job
+JOB_DEADLINE = int(os.getenv('JOB_DEADLINE', 6 * 60 * 60))
+
+# SQL result cache
+SQL_CACHE_TTL = int(os.getenv('SQL_CACHE_TTL', 300))
+SQL_CACHE_MAX_BYTES = int(os.getenv('SQL_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+SQL_CACHE_DB = os.getenv('SQL_CACHE_DB')  # Path to an SQLite file, disabled when unset
+
+# Identical queries re-attach to an execution started less than this many seconds ago,
+# or finished less than SQL_CACHE_TTL seconds ago
+EXECUTION_REUSE_TTL = int(os.getenv('EXECUTION_REUSE_TTL', 600))
+EXECUTION_REGISTRY_MAX_BYTES = 1024 * 1024
+
+# Large exports are spooled to disk instead of memory. SQL_EXPORT_MAX_BYTES caps the size of the
+# downloaded results file on disk, not memory use, which stays constant as rows are parsed incrementally
+SQL_EXPORT_MAX_BYTES = int(os.getenv('SQL_EXPORT_MAX_BYTES', 512 * 1024 * 1024))
+SQL_EXPORT_CHUNK_SIZE = 64 * 1024
+EXCEL_MAX_ROWS = 1048575  # Excel sheet limit, minus the header row
+ARROW_BATCH_SIZE = 10000  # Rows per Parquet/Arrow record batch
+DISCORD_UPLOAD_LIMIT = 25 * 1024 * 1024  # Used in DMs, where there is no guild limit
+DISCORD_MAX_ATTACHMENTS = 10
+
+# Table-image rendering worker processes
+RENDER_POOL_SIZE = int(os.getenv('RENDER_POOL_SIZE', 2))
+RENDER_QUEUE_LIMIT = int(os.getenv('RENDER_QUEUE_LIMIT', 20))
+
+# Web3 lookup cache (finalized blocks, transactions and metadata are kept until evicted)
+WEB3_CACHE_MAX_BYTES = int(os.getenv('WEB3_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+WEB3_CACHE_DB = os.getenv('WEB3_CACHE_DB')  # Path to an SQLite file, disabled when unset
+WEB3_PRICE_TTL = int(os.getenv('WEB3_PRICE_TTL', 30))
+WEB3_LATEST_TTL = int(os.getenv('WEB3_LATEST_TTL', 15))
+WEB3_FINALITY_BLOCKS = int(os.getenv('WEB3_FINALITY_BLOCKS', 64))  # Blocks this close to the head may be reorged
+WEB3_ENS_TTL = int(os.getenv('WEB3_ENS_TTL', 300))
+
+# /ask_ai answer cache (exact and similar questions)
+AI_CACHE_TTL = int(os.getenv('AI_CACHE_TTL', 24 * 3600))
+AI_CACHE_MAX_BYTES = int(os.getenv('AI_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+AI_CACHE_DB = os.getenv('AI_CACHE_DB')  # Path to an SQLite file, disabled when unset
+AI_CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', 5000))  # questions in the similarity index
+AI_CACHE_SIMILARITY = float(os.getenv('AI_CACHE_SIMILARITY', 0.85))  # 1.0 only reuses exact matches
+
+# Shared HTTP connection pool
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 20))
+HTTP_DNS_CACHE_TTL = int(os.getenv('HTTP_DNS_CACHE_TTL', 300))
+HTTP_KEEPALIVE_TIMEOUT = int(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 30))
 
 
 class ChainNetworkID(Enum):
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+import discord
+
+from config import (JOBS_DB, JOB_MAX_PER_USER, JOB_POLL_MAX_DELAY, JOB_DEADLINE, MAX_COLUMN_SHOW, MAX_ROW_SHOW,
+                    DISCORD_MESSAGE_LIMIT, DISCORD_UPLOAD_LIMIT, DISCORD_MAX_ATTACHMENTS)
+from apis.api_sql import start_execution, wait_for_execution, download_results, iter_result_rows
+from apis.poller import BackoffPoller
+from apis.rate_limit import PRIORITY_LOW
+from utils import format_table, write_rows_to_csv_gz, split_file, generate_random_filename
+from metrics import Gauge, phase_seconds
+
+ACTIVE_STATUSES = ("RUNNING",)
+
+# Characters of the query echoed in the results message
+JOB_QUERY_ECHO_CHARS = 300
+
+
+class JobStore:
+    """SQLite table of background SQL jobs, so running jobs survive restarts."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                               "id TEXT PRIMARY KEY, user_id INTEGER, channel_id INTEGER, query TEXT, "
+                               "execution_id TEXT, status TEXT, error TEXT, created_at REAL, finished_at REAL)")
+
+    def add(self, job):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO jobs (id, user_id, channel_id, query, execution_id, status, error, "
+                               "created_at, finished_at) VALUES (:id, :user_id, :channel_id, :query, "
+                               ":execution_id, :status, :error, :created_at, :finished_at)", job)
+
+    def update(self, job_id, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def active(self):
+        placeholders = ", ".join("?" for _ in ACTIVE_STATUSES)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT * FROM jobs WHERE status IN ({placeholders})",
+                                      ACTIVE_STATUSES).fetchall()
+        return [dict(row) for row in rows]
+
+
+class JobManager:
+    """
+    Runs long SQL queries in the background.
+
+    A job is submitted to Chainbase once; its execution id is stored so that
+    after a restart polling re-attaches to the same execution instead of
+    running the query again. Results are posted to the channel the job came
+    from, or sent by DM when the channel is not reachable or posting there fails.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.client = None
+        self._tasks = {}
+
+    def attach(self, client):
+        self.client = client
+
+    @property
+    def running(self):
+        return len(self._tasks)
+
+    async def submit(self, query, user_id, channel_id):
+        """Submit a query and start polling it in the background. Returns the job."""
+        active = [job for job in await asyncio.to_thread(self.store.active) if job['user_id'] == user_id]
+        if len(active) >= JOB_MAX_PER_USER:
+            raise ValueError(f"You already have {JOB_MAX_PER_USER} background jobs running")
+
+        execution_id, error = await start_execution(query)
+        if error:
+            raise ValueError(error)
+
+        job = {
+            'id': uuid.uuid4().hex[:8],
+            'user_id': user_id,
+            'channel_id': channel_id,
+            'query': query,
+            'execution_id': execution_id,
+            'status': "RUNNING",
+            'error': None,
+            'created_at': time.time(),
+            'finished_at': None,
+        }
+        await asyncio.to_thread(self.store.add, job)
+        self._start(job)
+        return job
+
+    async def resume(self):
+        """Re-attach to the executions of jobs that were running before a restart."""
+        for job in await asyncio.to_thread(self.store.active):
+            logging.info("Resuming job %s (execution %s)", job['id'], job['execution_id'])
+            self._start(job)
+
+    async def get(self, job_id):
+        return await asyncio.to_thread(self.store.get, job_id)
+
+    async def cancel(self, job_id, user_id):
+        """Stop tracking a job. Returns False if the job does not exist, is not running or is not the user's."""
+        job = await self.get(job_id)
+        if job is None or job['user_id'] != user_id or job['status'] not in ACTIVE_STATUSES:
+            return False
+        task = self._tasks.pop(job_id, None)
+        if task is not None:
+            task.cancel()
+        await asyncio.to_thread(self.store.update, job_id, status="CANCELLED", finished_at=time.time())
+        return True
+
+    def shutdown(self):
+        # Leave the jobs RUNNING in the store so they are resumed on the next start
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+
+    def _start(self, job):
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job['id']] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job['id'], None))
+
+    async def _run(self, job):
+        try:
+            # Deadline counts from submission, so restarts do not extend it
+            poller = BackoffPoller(max_delay=JOB_POLL_MAX_DELAY,
+                                   deadline=max(0.0, JOB_DEADLINE - (time.time() - job['created_at'])))
+            error = await wait_for_execution(job['execution_id'], poller, priority=PRIORITY_LOW)
+            await self._deliver(job, error)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Job %s failed: %s", job['id'], e)
+            await asyncio.to_thread(self.store.update, job['id'], status="FAILED", error=str(e),
+                                    finished_at=time.time())
+
+    async def _deliver(self, job, error):
+        query = job['query']
+        if len(query) > JOB_QUERY_ECHO_CHARS:
+            query = query[:JOB_QUERY_ECHO_CHARS] + "…"
+        content = f"<@{job['user_id']}> 🔍 ** Job `{job['id']}` finished: ** `{query}`\n\n"
+        file_paths = []
+        try:
+            with tempfile.TemporaryFile() as results_file:
+                if not error:
+                    error = await download_results(job['execution_id'], results_file)
+                if not error:
+                    columns, rows = await asyncio.to_thread(iter_result_rows, results_file)
+                    if columns is None:
+                        error = rows
+
+                if error:
+                    content += f"An error occurred: {error}"
+                else:
+                    # Keep the first rows for the preview while writing the file
+                    preview = []
+
+                    def capture(all_rows):
+                        for row in all_rows:
+                            if len(preview) < MAX_ROW_SHOW:
+                                preview.append(row[:MAX_COLUMN_SHOW])
+                            yield row
+
+                    with tempfile.NamedTemporaryFile(suffix='.csv.gz', delete=False) as export_file:
+                        file_paths.append(export_file.name)
+                    total_rows = await asyncio.to_thread(write_rows_to_csv_gz, columns, capture(rows),
+                                                         file_paths[0])
+                    content += f"📊  We found `{len(columns)}` columns and `{total_rows}` rows."
+                    table = format_table(columns[:MAX_COLUMN_SHOW], preview,
+                                         limit=DISCORD_MESSAGE_LIMIT - len(content))
+                    if table is not None:
+                        content += f"\n```\n{table}\n```"
+
+            await self._send(job, content, file_paths)
+            await asyncio.to_thread(self.store.update, job['id'], status="FAILED" if error else "FINISHED",
+                                    error=error, finished_at=time.time())
+        finally:
+            for path in file_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    async def _send(self, job, content, file_paths):
+        """Post the results in the job's channel, or by DM when the channel is gone or the bot may not post there."""
+        await self.client.wait_until_ready()
+        content = content[:DISCORD_MESSAGE_LIMIT]
+        try:
+            channel = (self.client.get_channel(job['channel_id'])
+                       or await self.client.fetch_channel(job['channel_id']))
+        except discord.HTTPException:
+            channel = None
+
+        if channel is not None:
+            upload_limit = channel.guild.filesize_limit if getattr(channel, 'guild', None) else DISCORD_UPLOAD_LIMIT
+            try:
+                await self._send_to(channel, content, file_paths, upload_limit)
+                return
+            except discord.HTTPException as e:
+                logging.warning("Could not post job %s in its channel, sending it by DM: %s", job['id'], e)
+
+        user = await self.client.fetch_user(job['user_id'])
+        await self._send_to(user, content, file_paths, DISCORD_UPLOAD_LIMIT)
+
+    async def _send_to(self, destination, content, file_paths, upload_limit):
+        if not file_paths:
+            await destination.send(content=content)
+            return
+
+        part_paths = await asyncio.to_thread(split_file, file_paths[0], upload_limit)
+        file_paths.extend(path for path in part_paths if path not in file_paths)
+        filename = generate_random_filename(extension='csv.gz')
+        if len(part_paths) == 1:
+            names = [filename]
+        else:
+            names = [f"{filename}.part{number}" for number in range(1, len(part_paths) + 1)]
+        pairs = list(zip(part_paths, names))
+        for i in range(0, len(pairs), DISCORD_MAX_ATTACHMENTS):
+            files = [discord.File(fp=path, filename=name) for path, name in pairs[i:i + DISCORD_MAX_ATTACHMENTS]]
+            with phase_seconds.time(phase="upload"):
+                await destination.send(content=content if i == 0 else None, files=files)
+
+
+# Shared background job manager
+job_manager = JobManager(JobStore(JOBS_DB))
+
+Gauge("background_jobs_running", "Background SQL jobs being polled", collect=lambda: [({}, job_manager.running)])
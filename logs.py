@@ -0,0 +1,140 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_MAX_CHARS, LOG_SAMPLE_RATE, LOG_QUEUE_SIZE
+
+# Pass as `extra=SAMPLED` for high-volume debug/info records (e.g. status polls)
+SAMPLED = {'sampled': True}
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {'message', 'asctime', 'taskName'}
+
+_listener = None
+
+
+def truncate(text, max_chars=LOG_MAX_CHARS):
+    """Cut `text` to `max_chars` characters, noting how much was dropped."""
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}…(+{len(text) - max_chars} chars)"
+
+
+class Truncated:
+    """
+    Log argument that is only converted to text, and cut to size, if the record is emitted.
+
+    Use for payloads of unknown size: `logger.debug("Response: %s", Truncated(response))`.
+    """
+    __slots__ = ('value', 'max_chars')
+
+    def __init__(self, value, max_chars=LOG_MAX_CHARS):
+        self.value = value
+        self.max_chars = max_chars
+
+    def __str__(self):
+        return truncate(str(self.value), self.max_chars)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a `rate` fraction of records logged with `extra=SAMPLED` below WARNING."""
+
+    def __init__(self, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and getattr(record, 'sampled', False):
+            if random.random() >= self.rate:
+                self.dropped += 1
+                return False
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Format records as text followed by `key=value` fields, or as one JSON object per line.
+
+    Fields are the `extra` values of the record. The message and every field are truncated.
+    """
+
+    def __init__(self, fmt=LOG_FORMAT):
+        super().__init__('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+        self.json = fmt == 'json'
+
+    def format(self, record):
+        message = truncate(record.getMessage())
+        fields = {key: truncate(str(value)) for key, value in vars(record).items()
+                  if key not in RECORD_ATTRIBUTES and key != 'sampled'}
+        if record.exc_info:
+            fields['exc_info'] = self.formatException(record.exc_info)
+
+        if self.json:
+            return json.dumps({'time': self.formatTime(record), 'level': record.levelname,
+                               'logger': record.name, 'message': message, **fields})
+
+        line = f"{self.formatTime(record)} - {record.levelname} - {record.name} - {message}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand records to the listener thread without blocking the caller.
+
+    Formatting is left to the listener thread, and records are dropped
+    (and counted) instead of waiting when the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Function to route all logging through a background thread
+def setup_logging():
+    """
+    Replace the root handlers with a queue handler whose records are
+    formatted and written to stdout by a background listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(StructuredFormatter())
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+# Function to flush and stop the logging thread
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,189 @@
+import bisect
+import contextlib
+import logging
+import time
+
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Every metric, in registration order
+registry = {}
+
+_runner = None
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """
+    A named family of values, one per label combination.
+
+    Values are either recorded directly or, when `collect` is given, read on demand
+    from `collect()`, which returns a list of (labels dict, value) pairs.
+    """
+    kind = None
+
+    def __init__(self, name, help, collect=None):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.values = {}
+        registry[name] = self
+
+    def samples(self):
+        """Return a list of (label key, value) pairs."""
+        if self.collect is not None:
+            return [(_label_key(labels), value) for labels, value in self.collect()]
+        return list(self.values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.samples():
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # Per-bucket counts (the last one is +Inf), sum, count
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the `with` block."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def quantile(self, q, key):
+        """Estimate the `q` quantile of one label combination from its buckets."""
+        counts, _, count = self.values[key]
+        target = q * count
+        cumulative = 0
+        lower = 0.0
+        for bound, bucket_count in zip(self.buckets, counts):
+            if bucket_count and cumulative + bucket_count >= target:
+                return lower + (bound - lower) * (target - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower = bound
+        return self.buckets[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+# Shared metrics, recorded from the bot and the API modules
+command_seconds = Histogram("command_seconds", "Slash command latency from the interaction to completion")
+phase_seconds = Histogram("phase_seconds", "Time spent in each phase of a command "
+                                           "(defer, execute, poll, fetch, render, upload)")
+command_errors = Counter("command_errors_total", "Slash commands that failed with an error")
+upstream_seconds = Histogram("upstream_seconds", "Upstream request latency until the response headers")
+upstream_requests = Counter("upstream_requests_total", "Upstream requests by budget and HTTP status")
+upstream_errors = Counter("upstream_errors_total", "Upstream calls that raised, by budget and kind "
+                                                   "(timeout, rate_limited, error)")
+upstream_retries = Counter("upstream_retries_total", "Upstream requests retried after a 429 answer")
+
+
+def latency_rows(histogram):
+    """Return [labels, count, average, p50, p95] rows summarizing a latency histogram."""
+    rows = []
+    for key, (_, total, count) in sorted(histogram.values.items()):
+        rows.append([",".join(str(value) for _, value in key) or "-", count, f"{total / count:.2f}s",
+                     f"{histogram.quantile(0.5, key):.2f}s", f"{histogram.quantile(0.95, key):.2f}s"])
+    return rows
+
+
+def value_rows():
+    """Return [metric, value] rows for every non-zero counter and gauge."""
+    rows = []
+    for metric in registry.values():
+        if isinstance(metric, Histogram):
+            continue
+        for key, value in metric.samples():
+            if value:
+                value = round(value, 2) if isinstance(value, float) else value
+                rows.append([f"{metric.name}{_format_labels(key)}", value])
+    return rows
+
+
+def render_metrics():
+    """Render every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry.values():
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(request):
+    return web.Response(text=render_metrics(), content_type="text/plain")
+
+
+# Function to serve /metrics for a local Prometheus scraper
+async def start_metrics_server():
+    global _runner
+    if METRICS_PORT is None or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info("Metrics served on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+
+# Function to stop the metrics server
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,189 @@
+import difflib
+import re
+
+from config import MAX_ROW_SHOW, SCAN_GUARDED_TABLES
+from catalog import table_catalog, catalog_schemas
+
+
+class PreflightError(ValueError):
+    pass
+
+
+# Strings, quoted identifiers, comments, words, numbers and single characters
+TOKEN_PATTERN = re.compile(r"""
+    (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*")
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<word>[A-Za-z_][\w$]*)
+  | (?P<number>\d+(?:\.\d+)?)
+  | (?P<space>\s+)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+# Address (20 bytes) and hash (32 bytes) literals
+HEX_LITERAL_PATTERN = re.compile(r"'0[xX][0-9a-fA-F]{40}'|'0[xX][0-9a-fA-F]{64}'")
+
+# Fenced code blocks in an AI answer, optionally tagged as SQL
+SQL_BLOCK_PATTERN = re.compile(r"```(?:sql)?[ \t]*\n(.*?)```", re.DOTALL | re.IGNORECASE)
+
+
+def tokenize(query):
+    """
+    Split SQL into (kind, text, depth) tokens, where depth is the parenthesis nesting level.
+
+    Returns:
+    - (tokens, depth after the last token), the depth being 0 when the parentheses are balanced.
+    """
+    tokens = []
+    depth = 0
+    for match in TOKEN_PATTERN.finditer(query):
+        kind = match.lastgroup
+        text = match.group()
+        if kind == 'other' and text == ')':
+            depth -= 1
+        tokens.append((kind, text, depth))
+        if kind == 'other' and text == '(':
+            depth += 1
+    return tokens, depth
+
+
+def referenced_tables(tokens):
+    """
+    Return the dotted `schema.table` names following FROM or JOIN.
+
+    FROM inside the parentheses of a function call, as in EXTRACT(YEAR FROM t.column),
+    is skipped; parentheses starting with SELECT or WITH hold a subquery.
+    """
+    tables = []
+    words = [(kind, text) for kind, text, _ in tokens if kind not in ('space', 'comment')]
+    # Whether each word is inside a function call's parentheses rather than a (sub)query
+    in_call = []
+    stack = []
+    for i, (kind, text) in enumerate(words):
+        in_call.append(bool(stack) and stack[-1])
+        if kind == 'other' and text == '(':
+            following = words[i + 1][1].upper() if i + 1 < len(words) else ""
+            stack.append(following not in ('SELECT', 'WITH'))
+        elif kind == 'other' and text == ')' and stack:
+            stack.pop()
+
+    for i, (kind, text) in enumerate(words[:-1]):
+        if kind == 'word' and text.upper() in ('FROM', 'JOIN') and not in_call[i]:
+            name = []
+            j = i + 1
+            while j < len(words) and words[j][0] in ('word', 'quoted'):
+                name.append(words[j][1].strip('"').lower())
+                if j + 1 < len(words) and words[j + 1][1] == '.':
+                    j += 2
+                else:
+                    break
+            if len(name) == 2:
+                tables.append(".".join(name))
+    return tables
+
+
+def _unbounded_scan(tokens, tables):
+    guarded = [table for table in tables if table.split(".")[-1] in SCAN_GUARDED_TABLES]
+    keywords = {text.upper() for kind, text, _ in tokens if kind == 'word'}
+    top_level = {text.upper() for kind, text, depth in tokens if kind == 'word' and depth == 0}
+    if guarded and 'LIMIT' not in top_level and 'WHERE' not in keywords:
+        return guarded[0]
+    return None
+
+
+def preflight(query, preview=False):
+    """
+    Check and rewrite a query locally before it is sent to Chainbase.
+
+    - Only a single SELECT (or WITH ... SELECT) statement is accepted.
+    - `schema.table` references must exist in the table catalog when the schema is known.
+    - Address and hash literals are lowercased to match the indexed data.
+    - Scans of large tables without WHERE or LIMIT are blocked unless in `preview`
+      mode, where `preview_query` bounds what is fetched and the row count is capped.
+
+    Returns:
+    - (rewritten query, list of warnings)
+    Raises PreflightError when the query should not be submitted.
+    """
+    query = query.strip().rstrip(";").strip()
+    if not query:
+        raise PreflightError("The query is empty")
+
+    tokens, depth = tokenize(query)
+    if depth != 0 or any(depth < 0 for _, _, depth in tokens):
+        raise PreflightError("Unbalanced parentheses in the query")
+    if any(kind == 'other' and text == ';' for kind, text, _ in tokens):
+        raise PreflightError("Only a single statement can be executed at a time")
+
+    keywords = [text.upper() for kind, text, _ in tokens if kind == 'word']
+    top_level = {text.upper() for kind, text, depth in tokens if kind == 'word' and depth == 0}
+    if not keywords or keywords[0] not in ('SELECT', 'WITH'):
+        raise PreflightError("Only SELECT queries are supported")
+
+    warnings = []
+    tables = referenced_tables(tokens)
+    for table in tables:
+        if table in table_catalog:
+            continue
+        suggestion = difflib.get_close_matches(table, table_catalog, n=1)
+        hint = f" Did you mean `{suggestion[0]}`?" if suggestion else ""
+        if table.split(".")[0] in catalog_schemas:
+            raise PreflightError(f"Unknown table `{table}`.{hint}")
+        warnings.append(f"Table `{table}` is not in the known table list.{hint}")
+
+    # Lowercase address and hash literals
+    rewritten = []
+    lowered = False
+    for kind, text, _ in tokens:
+        if kind == 'string' and HEX_LITERAL_PATTERN.fullmatch(text) and text != text.lower():
+            text = text.lower()
+            lowered = True
+        rewritten.append(text)
+    query = "".join(rewritten)
+    if lowered:
+        warnings.append("Address literals were lowercased to match the indexed data.")
+
+    guarded = [table for table in tables if table.split(".")[-1] in SCAN_GUARDED_TABLES]
+    if 'ORDER' in top_level and guarded:
+        warnings.append("ORDER BY on large tables is slow; drop it if you do not need sorted results.")
+
+    scanned = _unbounded_scan(tokens, tables)
+    if scanned and not preview:
+        raise PreflightError(f"Refusing to scan `{scanned}` without a WHERE or LIMIT clause")
+
+    return query, warnings
+
+
+def extract_sql(text):
+    """Return the first complete fenced code block of `text` holding a SELECT or WITH query, or None."""
+    for match in SQL_BLOCK_PATTERN.finditer(text):
+        query = match.group(1).strip().rstrip(";").strip()
+        if re.match(r"(SELECT|WITH)\b", query, re.IGNORECASE):
+            return query
+    return None
+
+
+def preview_query(query, max_row=MAX_ROW_SHOW):
+    """
+    Bound a checked query so that only the first `max_row` rows are fetched.
+
+    Without a top-level LIMIT one is appended, keeping the query's own ORDER BY in effect;
+    engines may drop the ORDER BY of a subquery, so only queries with a LIMIT are wrapped.
+    """
+    tokens, _ = tokenize(query)
+    words = [(text.upper(), depth) for kind, text, depth in tokens if kind in ('word', 'number')]
+    limits = [i for i, (text, depth) in enumerate(words) if depth == 0 and text in ('LIMIT', 'FETCH')]
+    if not limits:
+        return f"{query}\nLIMIT {max_row}"
+    # A small enough LIMIT already bounds the fetch
+    limit = words[limits[-1] + 1][0] if limits[-1] + 1 < len(words) else None
+    if words[limits[-1]][0] == 'LIMIT' and limit is not None and limit.isdigit() and int(limit) <= max_row:
+        return query
+    return f"SELECT * FROM (\n{query}\n) AS preview LIMIT {max_row}"
+
+
+def count_query(query, max_rows=None):
+    """Wrap a checked query to count its rows without fetching them, stopping at `max_rows` if given."""
+    if max_rows is not None:
+        query = f"SELECT 1 FROM (\n{query}\n) AS bounded LIMIT {max_rows}"
+    return f"SELECT COUNT(*) AS total_rows FROM (\n{query}\n) AS counted"
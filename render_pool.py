@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from config import RENDER_POOL_SIZE, RENDER_QUEUE_LIMIT
+from utils import render_table_image
+from metrics import Counter, Gauge
+
+# Worker processes for table-image rendering, started on first use
+_executor = None
+# One slot per worker; renders beyond that wait in a queue of at most RENDER_QUEUE_LIMIT
+_slots = asyncio.Semaphore(RENDER_POOL_SIZE)
+
+# Counters to help size the pool
+stats = {
+    "queued": 0,
+    "running": 0,
+    "renders": 0,
+    "rejected": 0,
+    "render_seconds_total": 0.0,
+    "render_seconds_max": 0.0,
+}
+
+
+Gauge("render_queued", "Table renders waiting for a worker", collect=lambda: [({}, stats["queued"])])
+Gauge("render_running", "Table renders in progress", collect=lambda: [({}, stats["running"])])
+Counter("render_rejected_total", "Table renders rejected because the queue was full",
+        collect=lambda: [({}, stats["rejected"])])
+Counter("render_seconds_total", "Time spent rendering table images in the workers",
+        collect=lambda: [({}, stats["render_seconds_total"])])
+
+
+def _init_worker():
+    # Select the non-interactive backend once per worker process
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _timed_render(columns, rows, figsize):
+    started_at = time.perf_counter()
+    png = render_table_image(columns, rows, figsize)
+    return png, time.perf_counter() - started_at
+
+
+def start_render_pool():
+    global _executor
+    if _executor is None:
+        # Spawn rather than fork: the bot process runs threads and an event loop
+        _executor = ProcessPoolExecutor(max_workers=RENDER_POOL_SIZE,
+                                        mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker)
+        logging.info("Render pool started with %d workers", RENDER_POOL_SIZE)
+    return _executor
+
+
+def shutdown_render_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        logging.info("Render pool stopped")
+    _executor = None
+
+
+async def render_table_png(columns, rows, figsize=(10, 2)):
+    """
+    Render a PNG table in the worker pool without blocking the event loop.
+
+    Returns:
+    - bytes: The PNG image.
+    Raises RuntimeError when the render queue is full.
+    """
+    if _slots.locked() and stats["queued"] >= RENDER_QUEUE_LIMIT:
+        stats["rejected"] += 1
+        raise RuntimeError("The image renderer is busy, please try again shortly")
+
+    stats["queued"] += 1
+    try:
+        await _slots.acquire()
+    finally:
+        stats["queued"] -= 1
+
+    stats["running"] += 1
+    try:
+        executor = start_render_pool()
+        loop = asyncio.get_running_loop()
+        png, seconds = await loop.run_in_executor(executor, _timed_render, columns, rows, figsize)
+    finally:
+        stats["running"] -= 1
+        _slots.release()
+
+    stats["renders"] += 1
+    stats["render_seconds_total"] += seconds
+    stats["render_seconds_max"] = max(stats["render_seconds_max"], seconds)
+    return png
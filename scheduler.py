@@ -0,0 +1,149 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+
+from config import (SQL_MAX_IN_FLIGHT, SQL_MAX_QUEUED, SQL_MAX_PER_USER, SQL_MAX_PER_GUILD,
+                    SQL_GUILD_WEIGHTS)
+from metrics import Counter, Gauge
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class FairScheduler:
+    """
+    Weighted fair queue for heavy SQL commands.
+
+    Each guild (or DM user) is a flow. A job gets the tag
+    `max(virtual time, last tag of its flow) + cost / weight` and the lowest
+    tag runs next, so a guild flooding the queue only delays its own jobs.
+    Requests over the per-user or per-guild quota, or arriving while the queue
+    is full, are rejected up front instead of timing out later.
+    """
+
+    def __init__(self, max_in_flight=SQL_MAX_IN_FLIGHT, max_queued=SQL_MAX_QUEUED,
+                 max_per_user=SQL_MAX_PER_USER, max_per_guild=SQL_MAX_PER_GUILD, weights=None):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.max_per_guild = max_per_guild
+        self.weights = weights if weights is not None else SQL_GUILD_WEIGHTS
+        self.in_flight = 0
+        self.rejected = 0
+        self._virtual_time = 0.0
+        self._last_tags = {}
+        self._per_user = {}
+        self._per_guild = {}
+        self._waiting = []  # heap of (tag, sequence, future, on_position)
+        self._sequence = itertools.count()
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    def _check_quota(self, user_id, flow):
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            raise QueueFullError(f"You already have {self.max_per_user} queries running, "
+                                 f"please wait for them to finish")
+        if self._per_guild.get(flow, 0) >= self.max_per_guild:
+            raise QueueFullError("This server has too many queries running, please try again shortly")
+        if self.in_flight >= self.max_in_flight and len(self._waiting) >= self.max_queued:
+            raise QueueFullError("The query queue is full, please try again shortly")
+
+    def _dispatch(self):
+        dispatched = False
+        while self._waiting and self.in_flight < self.max_in_flight:
+            tag, _, future, _ = heapq.heappop(self._waiting)
+            if future.done():  # Cancelled while waiting
+                continue
+            self._virtual_time = tag
+            self.in_flight += 1
+            future.set_result(None)
+            dispatched = True
+        if dispatched:
+            self._notify_positions()
+
+    def _notify_positions(self):
+        for position, (_, _, future, on_position) in enumerate(sorted(self._waiting), start=1):
+            if on_position is not None and not future.done():
+                asyncio.create_task(self._report(on_position, position))
+
+    @staticmethod
+    async def _report(on_position, position):
+        try:
+            await on_position(position)
+        except Exception as e:
+            logging.error("Failed to report queue position: %s", e)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, guild_id=None, cost=1, on_position=None):
+        """
+        Wait for a turn to run a heavy job.
+
+        Parameters:
+        - user_id: Discord user id, for the per-user quota.
+        - guild_id: Discord guild id (None in DMs), the fair-share flow.
+        - cost: Relative cost of the job, e.g. higher for exports.
+        - on_position: Optional coroutine `on_position(position)` called when the queue position changes.
+
+        Raises QueueFullError when the job cannot be accepted.
+        """
+        flow = guild_id if guild_id is not None else f"user:{user_id}"
+        try:
+            self._check_quota(user_id, flow)
+        except QueueFullError:
+            self.rejected += 1
+            raise
+
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self._per_guild[flow] = self._per_guild.get(flow, 0) + 1
+        started = False
+        try:
+            tag = max(self._virtual_time, self._last_tags.get(flow, 0.0)) + cost / self.weights.get(guild_id, 1)
+            self._last_tags[flow] = tag
+            sequence = next(self._sequence)
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiting, (tag, sequence, future, on_position))
+            self._dispatch()
+
+            try:
+                # Reporting the position awaits Discord, so a cancellation can land here too
+                if not future.done() and on_position is not None:
+                    ahead = sum(1 for entry in self._waiting if entry[:2] < (tag, sequence))
+                    await self._report(on_position, ahead + 1)
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    started = True  # Got the slot just as we were cancelled
+                else:
+                    future.cancel()
+                    self._waiting = [entry for entry in self._waiting if entry[2] is not future]
+                    heapq.heapify(self._waiting)
+                raise
+            started = True
+            yield
+        finally:
+            if started:
+                self.in_flight -= 1
+            self._per_user[user_id] -= 1
+            self._per_guild[flow] -= 1
+            if not self._per_user[user_id]:
+                del self._per_user[user_id]
+            if not self._per_guild[flow]:
+                del self._per_guild[flow]
+            self._dispatch()
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "queued": self.queued, "rejected": self.rejected}
+
+
+# Shared scheduler for /sql and the export commands
+sql_scheduler = FairScheduler()
+
+Gauge("sql_queue_in_flight", "SQL commands running", collect=lambda: [({}, sql_scheduler.in_flight)])
+Gauge("sql_queue_waiting", "SQL commands waiting for a turn", collect=lambda: [({}, sql_scheduler.queued)])
+Counter("sql_queue_rejected_total", "SQL commands rejected by the queue quotas",
+        collect=lambda: [({}, sql_scheduler.rejected)])
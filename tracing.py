@@ -0,0 +1,173 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+
+from config import TRACE_SAMPLE_RATE, TRACE_FILE, TRACE_COLLECTOR_URL, TRACE_QUEUE_SIZE
+
+# Span of the current task; child tasks inherit it through their copied context
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'start', 'error')
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self, end):
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    __slots__ = ('trace_id', 'root')
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.root = None
+
+
+class SpanExporter:
+    """
+    Write finished spans from a background thread, as JSON lines to `path`
+    or as JSON batches POSTed to `collector_url`.
+
+    Spans are dropped instead of blocking when the queue is full.
+    """
+
+    def __init__(self, path=TRACE_FILE, collector_url=TRACE_COLLECTOR_URL, max_queued=TRACE_QUEUE_SIZE):
+        self.path = path
+        self.collector_url = collector_url
+        self._queue = queue.Queue(max_queued)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def export(self, span):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self._queue.get(timeout=1))
+                except queue.Empty:
+                    break
+            spans = [span for span in batch if span is not None]
+            if spans:
+                try:
+                    self._write(spans)
+                except Exception as e:
+                    logging.error("Failed to export %d spans: %s", len(spans), e)
+            if None in batch:
+                return
+
+    def _write(self, spans):
+        if self.collector_url:
+            request = urllib.request.Request(self.collector_url, data=json.dumps({"spans": spans}).encode(),
+                                             headers={"Content-Type": "application/json"})
+            urllib.request.urlopen(request, timeout=10).close()
+        else:
+            with open(self.path, "a") as f:
+                f.writelines(json.dumps(span, default=str) + "\n" for span in spans)
+
+    def shutdown(self):
+        """Flush the queued spans and stop the thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+# Shared exporter for all traces
+exporter = SpanExporter()
+
+
+@contextlib.contextmanager
+def start_trace(name, sample_rate=TRACE_SAMPLE_RATE, **attributes):
+    """
+    Start a trace whose root span covers the `with` block, if it is sampled.
+
+    Yields the root span, or None when the trace is not sampled.
+    """
+    if random.random() >= sample_rate:
+        token = _current_span.set(None)
+        try:
+            yield None
+        finally:
+            _current_span.reset(token)
+        return
+
+    trace = Trace()
+    with _record(trace, name, None, attributes) as root:
+        trace.root = root
+        yield root
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Record a child span of the current span covering the `with` block.
+
+    Outside a sampled trace this does nothing and yields None.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    with _record(parent.trace, name, parent.span_id, attributes) as child:
+        yield child
+
+
+def set_trace_attributes(**attributes):
+    """Add attributes to the root span of the current trace, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.trace.root.set(**attributes)
+
+
+@contextlib.contextmanager
+def _record(trace, name, parent_id, attributes):
+    current = Span(trace, name, parent_id, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        exporter.export(current.to_dict(time.time()))
@@ -1,51 +1,78 @@
-from tabulate import tabulate
 import pandas as pd
-from config import MAX_COLUMN_SHOW, MAX_ROW_SHOW, ChainNetworkID
-import matplotlib.pyplot as plt
+from config import (MAX_COLUMN_SHOW, MAX_ROW_SHOW, EXCEL_MAX_ROWS, ARROW_BATCH_SIZE, DISCORD_MESSAGE_LIMIT,
+                    TEXT_TABLE_MAX_WIDTH, TEXT_TABLE_MIN_COLUMN_WIDTH, BATCH_MAX_ITEMS, BATCH_CONCURRENCY,
+                    ChainNetworkID)
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import uuid
 import os
 import tempfile
 import random
 import io
 import string
+import asyncio
+import re
+import csv
+import gzip
+import itertools
+import json
+import xlsxwriter
+import pyarrow as pa
+import pyarrow.parquet as pq
 from enum import Enum
 
 
-def format_as_table(columns, data):
-    """Formats the query result as a table."""
-    headers = [col['name'] for col in columns]
-    table = tabulate(data, headers=headers, tablefmt="pretty")
-    return table
-
-
-def format_dataframe_table(df):
-    # Convert the DataFrame to a text-based table
-    table_str = tabulate(df, headers='keys', tablefmt='grid')
-    return table_str
-
-
-def format_db(df):
-    df = pd.DataFrame(data)
-    # Formatting the DataFrame for Discord
-    formatted_data = "\n".join([f"{col} : {df.at[0, col]}" for col in df.columns])
-    return formatted_data
-
+def format_table(columns, rows, max_width=TEXT_TABLE_MAX_WIDTH, limit=DISCORD_MESSAGE_LIMIT):
+    """
+    Render rows as a monospace text table that fits a Discord message.
 
-def format_table(columns, data):
-    """Convert columns and data into a tabular format string wrapped in code blocks."""
-    # Create the header row
-    header = " | ".join(columns)
-    # Create a separator row
-    separator = "-|-".join(["-" * len(col) for col in columns])
-    # Create the data rows
-    rows = []
-    for row in data:
-        rows.append(" | ".join(str(item) for item in row))
+    Columns are shrunk, widest first, until each line fits `max_width`
+    characters; cells that do not fit keep their last characters (the
+    distinctive part of addresses and hashes) behind a leading '…'.
 
-    # Combine header, separator, and rows into the final table string
-    table = f"```\n{header}\n{separator}\n" + "\n".join(rows) + "\n```"
+    Parameters:
+    - columns: List of column names.
+    - rows: List of rows, where each row is a list of values.
+    - max_width: Maximum line width in characters.
+    - limit: Maximum size of the whole table in characters.
 
-    return table
+    Returns:
+    - str: The table, or None if it does not fit within `limit`.
+    """
+    header = [str(column) for column in columns]
+    cells = [[str(value) for value in row] for row in rows]
+
+    widths = [len(name) for name in header]
+    for row in cells:
+        for i, value in enumerate(row):
+            if len(value) > widths[i]:
+                widths[i] = len(value)
+
+    # Shrink the widest column until the lines fit
+    total_width = sum(widths) + 3 * (len(widths) - 1)
+    while total_width > max_width:
+        widest = max(range(len(widths)), key=widths.__getitem__)
+        if widths[widest] <= TEXT_TABLE_MIN_COLUMN_WIDTH:
+            break
+        widths[widest] -= 1
+        total_width -= 1
+
+    def fit(value, width):
+        if len(value) > width:
+            value = '…' + value[len(value) - width + 1:]
+        return value.ljust(width)
+
+    lines = [" | ".join(fit(name, width) for name, width in zip(header, widths)).rstrip(),
+             "-+-".join("-" * width for width in widths)]
+    size = len(lines[0]) + len(lines[1]) + 1
+    for row in cells:
+        line = " | ".join(fit(value, width) for value, width in zip(row, widths)).rstrip()
+        size += len(line) + 1
+        if size > limit:
+            return None
+        lines.append(line)
+
+    return "\n".join(lines)
 
 
 def truncate_text(text, max_length=15, stars_count=10):
@@ -112,22 +139,42 @@ def get_table(columns, data, max_column=MAX_COLUMN_SHOW, max_row=MAX_ROW_SHOW, h
     return df, total_columns, total_rows
 
 
-def save_dataframe_as_image(df, file_name=None, figsize=(10, 2), file_extension='png'):
+def get_preview(columns, data, max_column=MAX_COLUMN_SHOW, max_row=MAX_ROW_SHOW, hidden=True):
     """
-    Save a DataFrame as an image file with a specified name or a randomly generated name in a temp directory.
+    Like `get_table`, but slices plain lists instead of building a DataFrame.
+
+    Returns:
+    - (column names, rows, total columns, total rows)
+    """
+    total_columns = len(columns)
+    total_rows = len(data)
+    rows = [row[:max_column] for row in data[:max_row]]
+
+    # Truncate each cell
+    if hidden:
+        rows = [[truncate_text(value) for value in row] for row in rows]
+
+    return columns[:max_column], rows, total_columns, total_rows
+
+
+def save_dataframe_as_image(df, file_name=None, figsize=(10, 2), file_extension='png', to_file=False):
+    """
+    Render a DataFrame as an image, in memory by default.
 
     Parameters:
-    - df (pd.DataFrame): The DataFrame to save as an image.
-    - file_name (str): The name of the file to save. If None, a random name will be generated.
+    - df (pd.DataFrame): The DataFrame to render.
+    - file_name (str): With `to_file`, the name of the file to save. If None, a random name will be generated.
     - figsize (tuple): Size of the figure (width, height).
-    - file_extension (str): File extension for the image file (e.g., 'png', 'jpg').
+    - file_extension (str): Image format (e.g., 'png', 'jpg').
+    - to_file (bool): Debugging opt-in to also write the image to the temp directory.
 
     Returns:
-    - str: The full path of the saved image file.
+    - io.BytesIO: The image, ready to pass to `discord.File`, or the full path of
+      the saved image file when `to_file` is set.
     """
-
-    # Create a temporary directory
-    temp_dir = tempfile.gettempdir()
+    image = render_table_image(df.columns.tolist(), df.values.tolist(), figsize, file_extension)
+    if not to_file:
+        return io.BytesIO(image)
 
     # Use the specified file name or generate a random one
     if file_name is None:
@@ -137,22 +184,246 @@ def save_dataframe_as_image(df, file_name=None, figsize=(10, 2), file_extension=
         if not file_name.lower().endswith(f'.{file_extension}'):
             file_name += f'.{file_extension}'
 
-    file_path = os.path.join(temp_dir, file_name)
+    file_path = os.path.join(tempfile.gettempdir(), file_name)
+    with open(file_path, 'wb') as file:
+        file.write(image)
+
+    return file_path
+
+
+def write_rows_to_excel(columns, rows, file_path, max_rows=EXCEL_MAX_ROWS):
+    """
+    Write rows to an Excel file in xlsxwriter's constant_memory mode, so only
+    the current row is held in memory no matter how large the result is.
+
+    Parameters:
+    - columns: List of column names.
+    - rows: Iterable of rows, consumed lazily.
+    - file_path: Path of the Excel file to create.
+    - max_rows: Write at most this many data rows (Excel's sheet limit by default);
+      the rows after it are only counted.
+
+    Returns:
+    - int: The number of data rows in `rows`, more than `max_rows` when rows were dropped.
+    """
+    workbook = xlsxwriter.Workbook(file_path, {'constant_memory': True, 'strings_to_urls': False})
+    worksheet = workbook.add_worksheet('Sheet1')
+    worksheet.write_row(0, 0, columns)
+
+    total_rows = 0
+    for row in rows:
+        total_rows += 1
+        if total_rows > max_rows:
+            continue
+        worksheet.write_row(total_rows, 0, [
+            value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+            for value in row
+        ])
+
+    workbook.close()
+    return total_rows
+
+
+def _cell_value(value):
+    """Keep scalars as they are and serialize nested values (lists, objects) to JSON."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return json.dumps(value, default=str)
+
+
+def write_rows_to_csv_gz(columns, rows, file_path):
+    """Write rows to a gzip-compressed CSV file, one row at a time. Returns the number of data rows."""
+    total_rows = 0
+    with gzip.open(file_path, 'wt', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([_cell_value(value) for value in row])
+            total_rows += 1
+    return total_rows
+
+
+# Range of Arrow int64 columns; larger integers (e.g. uint256 token amounts in wei) are kept as strings
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def _is_int64(value):
+    return isinstance(value, int) and not isinstance(value, bool) and INT64_MIN <= value <= INT64_MAX
+
+
+# Arrow type of each kind of column; columns mixing kinds are widened (int to float, anything else to string)
+ARROW_TYPES = {None: pa.string(), 'bool': pa.bool_(), 'int': pa.int64(), 'float': pa.float64(), 'string': pa.string()}
+
+
+def _widen_kind(kind, value):
+    """Return the kind of a column of `kind` once it also holds `value`."""
+    if value is None or kind == 'string':
+        return kind
+    if isinstance(value, bool):
+        new = 'bool'
+    elif _is_int64(value):
+        new = 'int'
+    elif isinstance(value, float):
+        new = 'float'
+    else:
+        new = 'string'
+    if kind is None or kind == new:
+        return new
+    if {kind, new} == {'int', 'float'}:
+        return 'float'
+    return 'string'
+
+
+def _infer_arrow_schema(columns, rows):
+    """Infer an Arrow schema that fits every value of `rows`."""
+    kinds = [None] * len(columns)
+    for row in rows:
+        for i in range(len(columns)):
+            kinds[i] = _widen_kind(kinds[i], _cell_value(row[i]))
+    return pa.schema([(name, ARROW_TYPES[kind]) for name, kind in zip(columns, kinds)])
+
+
+def _fits_arrow_type(value, arrow_type):
+    """Whether `value` can be stored in a column of `arrow_type` without being changed."""
+    if value is None or pa.types.is_string(arrow_type):
+        return True
+    if pa.types.is_boolean(arrow_type):
+        return isinstance(value, bool)
+    if pa.types.is_integer(arrow_type):
+        return _is_int64(value)
+    return isinstance(value, float) or _is_int64(value)
+
+
+def _iter_arrow_batches(columns, rows, batch_size=ARROW_BATCH_SIZE):
+    """
+    Yield (schema, record batch) pairs.
 
-    # Create a plot of the dataframe
-    fig, ax = plt.subplots(figsize=figsize)
+    When `rows` can be iterated more than once (like the rows of a downloaded results file)
+    the schema is inferred from every row in a first pass, otherwise from the first batch.
+    """
+    schema = _infer_arrow_schema(columns, rows) if iter(rows) is not rows else None
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, batch_size))
+        if not chunk and schema is not None:
+            return
+        if schema is None:
+            schema = _infer_arrow_schema(columns, chunk)
+        column_values = [[_cell_value(row[i]) for row in chunk] for i in range(len(columns))]
+        arrays = []
+        for field, values in zip(schema, column_values):
+            if pa.types.is_string(field.type):
+                values = [value if value is None else str(value) for value in values]
+            # Arrow would silently truncate floats in an int64 column, so check the later batches first
+            elif not all(_fits_arrow_type(value, field.type) for value in values):
+                raise ValueError(f"Column `{field.name}` has values that do not fit the {field.type} type of its "
+                                 f"first rows, try the csv.gz format instead")
+            try:
+                arrays.append(pa.array(values, type=field.type))
+            except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+                raise ValueError(f"Column `{field.name}` has mixed types, try the csv.gz format instead")
+        yield schema, pa.RecordBatch.from_arrays(arrays, schema=schema)
+        if not chunk:
+            return
+
+
+def write_rows_to_parquet(columns, rows, file_path):
+    """Write rows to a zstd-compressed Parquet file batch by batch. Returns the number of data rows."""
+    total_rows = 0
+    writer = None
+    try:
+        for schema, batch in _iter_arrow_batches(columns, rows):
+            if writer is None:
+                writer = pq.ParquetWriter(file_path, schema, compression='zstd')
+            writer.write_batch(batch)
+            total_rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return total_rows
+
+
+def write_rows_to_arrow(columns, rows, file_path):
+    """Write rows to an Arrow IPC file (zstd-compressed) batch by batch. Returns the number of data rows."""
+    total_rows = 0
+    writer = None
+    try:
+        for schema, batch in _iter_arrow_batches(columns, rows):
+            if writer is None:
+                writer = pa.ipc.new_file(file_path, schema,
+                                         options=pa.ipc.IpcWriteOptions(compression='zstd'))
+            writer.write_batch(batch)
+            total_rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return total_rows
+
+
+# Export formats for /sql_export: file extension -> writer
+EXPORT_WRITERS = {
+    'xlsx': write_rows_to_excel,
+    'csv.gz': write_rows_to_csv_gz,
+    'parquet': write_rows_to_parquet,
+    'arrow': write_rows_to_arrow,
+}
+
+
+def split_file(file_path, part_size):
+    """
+    Split a file into numbered parts of at most `part_size` bytes.
+
+    Returns:
+    - list: Paths of the parts, or just `file_path` if it already fits.
+    """
+    if os.path.getsize(file_path) <= part_size:
+        return [file_path]
+
+    part_paths = []
+    with open(file_path, 'rb') as file:
+        part_number = 0
+        while True:
+            data = file.read(part_size)
+            if not data:
+                break
+            part_number += 1
+            part_path = f"{file_path}.part{part_number}"
+            with open(part_path, 'wb') as part:
+                part.write(data)
+            part_paths.append(part_path)
+    return part_paths
+
+
+def render_table_image(columns, rows, figsize=(10, 2), file_format='png'):
+    """
+    Render a table as image bytes with matplotlib's object-oriented API.
+
+    Unlike `pyplot`, this keeps no global figure state, so it is safe to call
+    from worker processes (see `render_pool`).
+
+    Parameters:
+    - columns: List of column names.
+    - rows: List of rows, where each row is a list of cell strings.
+    - figsize (tuple): Size of the figure (width, height).
+    - file_format (str): Image format (e.g., 'png', 'jpg').
+
+    Returns:
+    - bytes: The encoded image. Wrapping it in `io.BytesIO` does not copy it.
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
     ax.axis('tight')
     ax.axis('off')
-    ax.table(cellText=df.values,
-             colLabels=df.columns,
+    ax.table(cellText=rows,
+             colLabels=columns,
              cellLoc='center',
              loc='center')
 
-    # Save the plot as an image with the specified or random name
-    plt.savefig(file_path, bbox_inches='tight', pad_inches=0.1)
-    plt.close(fig)  # Close the figure to avoid memory leaks
-
-    return file_path
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=file_format, bbox_inches='tight', pad_inches=0.1)
+    return buffer.getvalue()
 
 
 def split_message(content, limit=1900):
@@ -160,10 +431,10 @@ def split_message(content, limit=1900):
     return [content[i:i + limit] for i in range(0, len(content), limit)]
 
 
-def generate_random_filename(prefix="Chainbase_", length=10):
+def generate_random_filename(prefix="Chainbase_", length=10, extension="xlsx"):
     """Generate a random filename with a specified prefix."""
     random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=length))
-    return f"{prefix}{random_str}.xlsx"
+    return f"{prefix}{random_str}.{extension}"
 
 
 def get_network_id(chain_name):
@@ -179,3 +450,77 @@ def get_network_id(chain_name):
 
     # Return the network ID if the chain name exists
     return chain_network_ids.get(chain_name_lower, None)
+
+
+def parse_batch_items(text, default_chain, max_items=BATCH_MAX_ITEMS):
+    """
+    Parse a list of addresses for the batch commands.
+
+    Items are separated by commas or whitespace and may name their own chain
+    as `chain:address`, otherwise `default_chain` is used. Repeated items
+    (compared case-insensitively) are dropped.
+
+    Returns:
+    - list: Unique (chain name, chain id, address) tuples, in input order.
+    Raises ValueError on an unknown chain or too many items.
+    """
+    items = []
+    seen = set()
+    for token in re.split(r"[\s,]+", text.strip()):
+        if not token:
+            continue
+        chain, _, address = token.rpartition(":")
+        chain = chain or default_chain
+        chain_id = get_network_id(chain)
+        if chain_id is None:
+            raise ValueError(f"Unknown chain `{chain}`")
+        key = (chain_id, address.lower())
+        if key in seen:
+            continue
+        seen.add(key)
+        items.append((chain, chain_id, address))
+
+    if len(items) > max_items:
+        raise ValueError(f"Too many items, the limit is {max_items}")
+    return items
+
+
+async def gather_limited(func, args_list, limit=BATCH_CONCURRENCY):
+    """Await `func(*args)` for every args tuple with at most `limit` calls at once, keeping the order."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(args):
+        async with semaphore:
+            return await func(*args)
+
+    return await asyncio.gather(*(run(args) for args in args_list))
+
+
+async def iter_limited(func, args_list, limit=BATCH_CONCURRENCY):
+    """
+    Run `func(*args)` for every args tuple with at most `limit` calls at once and
+    yield the results in input order as soon as each one (and those before it) is done.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(args):
+        async with semaphore:
+            return await func(*args)
+
+    tasks = [asyncio.ensure_future(run(args)) for args in args_list]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        # Stop outstanding fetches if the consumer gives up early
+        for task in tasks:
+            task.cancel()
+
+
+def rows_to_csv_bytes(columns, rows):
+    """Serialize a small table to CSV bytes for a Discord attachment."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')